@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+################################################################
+# bench_parse_kreport.py compares the per-line parser of
+# combine_kreports_modified.py (process_kraken_report) with the
+# bulk parser (read_report_columns) on a large synthetic report, once
+# for the parsing alone and once including adding the parsed report to
+# the combined tree: the per-line lines with the garbage collector
+# running (add_report_lines) against the columns with add_report
+#
+# Parameters:
+#   -h, --help................show help message.
+#   -n X, --lines X...........number of lines of the synthetic report [default 1000000]
+#   -d X, --max-depth X.......maximum indentation depth of the taxa [default 30]
+#   -k, --keep................keep the synthetic report (path is printed)
+####################################################################
+import os, sys, argparse
+import gc
+import random
+import tempfile
+import time
+
+from combine_kreports_modified import process_kraken_report, read_report_columns, add_report, add_report_lines
+
+####################################################################
+# write_report
+# usage: writes a synthetic kraken report with random counts and depths
+def write_report(r_name, num_lines, max_depth):
+    rng = random.Random(42)
+    levels = ['D','P','C','O','F','G','S','-']
+    r_file = open(r_name, 'w')
+    r_file.write(" 10.00\t1000\t1000\tU\t0\tunclassified\n")
+    r_file.write(" 90.00\t9000\t10\tR\t1\troot\n")
+    depth = 1
+    for i in range(num_lines - 2):
+        depth = rng.randint(1, min(depth + 1, max_depth))
+        all_reads = rng.randint(0, 100000)
+        r_file.write("%6.2f\t%i\t%i\t%s\t%i\t%staxon %i\n" % (rng.random() * 100,
+            all_reads, all_reads // 2, levels[depth % len(levels)], i + 2, "  " * depth, i))
+    r_file.close()
+
+####################################################################
+# parse_per_line
+# usage: parses a report line by line with process_kraken_report
+# returns: list of parsed lines (tuples)
+def parse_per_line(r_name):
+    per_line = []
+    curr_file = open(r_name, 'r')
+    for line in curr_file:
+        report_vals = process_kraken_report(line)
+        if len(report_vals) < 5:
+            continue
+        per_line.append(tuple(report_vals))
+    curr_file.close()
+    return per_line
+
+####################################################################
+# Main method
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n','--lines',dest='lines',type=int,default=1000000,
+        help='Number of lines of the synthetic report [default 1000000]')
+    parser.add_argument('-d','--max-depth',dest='max_depth',type=int,default=30,
+        help='Maximum indentation depth of the taxa [default 30]')
+    parser.add_argument('-k','--keep',dest='keep',action='store_true',default=False,
+        help='Keep the synthetic report')
+    args = parser.parse_args()
+
+    fd, r_name = tempfile.mkstemp(suffix='.report')
+    os.close(fd)
+    sys.stdout.write(">>WRITING SYNTHETIC REPORT (%i lines)\n" % args.lines)
+    write_report(r_name, args.lines, args.max_depth)
+
+    # Per-line parser
+    start = time.perf_counter()
+    per_line = parse_per_line(r_name)
+    t_line = time.perf_counter() - start
+
+    # Bulk parser
+    start = time.perf_counter()
+    columns = read_report_columns(r_name)
+    t_bulk = time.perf_counter() - start
+
+    if list(zip(*columns)) != per_line:
+        sys.stderr.write("ERROR: parsers disagree\n")
+        sys.exit(1)
+    per_line = columns = None
+    gc.collect()
+
+    # Parsing and adding to the combined tree
+    start = time.perf_counter()
+    line_tree = {}
+    add_report_lines(1, parse_per_line(r_name), line_tree, {0:0}, None)
+    t_line_tree = time.perf_counter() - start
+
+    num_taxa = len(line_tree)
+    line_tree = None
+    gc.collect()
+
+    start = time.perf_counter()
+    bulk_tree = {}
+    add_report(1, zip(*read_report_columns(r_name)), bulk_tree, {0:0})
+    t_bulk_tree = time.perf_counter() - start
+
+    if len(bulk_tree) != num_taxa:
+        sys.stderr.write("ERROR: combined trees disagree\n")
+        sys.exit(1)
+    sys.stdout.write("parsing only\n")
+    sys.stdout.write("  process_kraken_report (per line): %8.3f s\n" % t_line)
+    sys.stdout.write("  read_report_columns (bulk):       %8.3f s\n" % t_bulk)
+    sys.stdout.write("  speedup:                          %8.2fx\n" % (t_line / t_bulk))
+    sys.stdout.write("parsing + adding to the tree\n")
+    sys.stdout.write("  process_kraken_report (per line): %8.3f s\n" % t_line_tree)
+    sys.stdout.write("  read_report_columns (bulk):       %8.3f s\n" % t_bulk_tree)
+    sys.stdout.write("  speedup:                          %8.2fx\n" % (t_line_tree / t_bulk_tree))
+
+    if args.keep:
+        sys.stdout.write("synthetic report: %s\n" % r_name)
+    else:
+        os.remove(r_name)
+
+####################################################################
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,317 @@
+#!/usr/bin/env python
+################################################################
+# combine_koutputs.py takes the per-read classification output of
+# kraken2 (--output) of multiple samples and combines them into a
+# single report file, without writing per-sample kraken reports
+#
+# The combined report has the same layout as the output of
+# combine_kreports_modified.py (whose tree, filters and writers are used)
+
+#################################################################
+# This program streams multiple Kraken2 output files, counts the reads
+# assigned to every taxid and builds the clade totals of every sample from a
+# local NCBI taxonomy (nodes.dmp/names.dmp, e.g. the taxonomy/ directory of
+# the kraken2 database), as kraken2 does for its reports
+#
+# Parameters:
+#   -h, --help................show help message.
+#   -k X, --kraken-output X...all input kraken2 output files (separated by spaces), plain text or
+#                             compressed with gzip, bzip2, xz or zstd (detected from the file)
+#   --taxonomy X..............directory with nodes.dmp and names.dmp
+#   --nodes X, --names X......nodes.dmp and names.dmp files (instead of --taxonomy)
+#   -o X, --output X..........output kraken report filename
+#   --sample-names............sample names for each kraken output file (separated by spaces)
+#                             [if none are given, each sample named from input file name]
+#   --single-tax-level........Set this to create single tables for each major taxonomic level
+#                             in addition to overall merged report
+#   -t X, --threads X.........number of worker processes used to count the reads [default 1]
+#   --chunk-lines X...........number of lines of an output file counted at once [default 4000000]
+#   --compact, --tax-level-container, --ranks, --min-reads, --min-samples, --taxid-include,
+#   --taxid-exclude, --format
+#                             as in combine_kreports_modified.py
+# Each Input file format (tab-delimited, one line per read or read pair)
+#   - C (classified) or U (unclassified)
+#   - read ID
+#   - NCBI taxonomic ID (0 = unclassified), or 'name (taxid X)' with --use-names
+#   - read length(s)
+#   - LCA k-mer mapping
+# Output file format: see combine_kreports_modified.py
+# Methods
+#   - main
+#   - input_compression
+#   - count_output
+#   - load_taxonomy
+#   - build_report
+####################################################################
+import os, sys, argparse
+from multiprocessing import Pool
+
+try:
+    import numpy as np
+    import pandas as pd
+except ImportError as err:
+    sys.stderr.write("combine_koutputs.py requires %s to be installed\n" % err.name)
+    sys.exit(1)
+
+from combine_kreports_modified import (OUTPUT_FORMATS, GZIP_MAGIC, BZIP2_MAGIC, XZ_MAGIC,
+    ZSTD_MAGIC, map_lvls, CountMatrix, add_report, add_output_args, make_taxon_filter, new_node,
+    sample_name, write_combined)
+
+# Number of lines of a kraken2 output file counted at once
+CHUNK_LINES = 4000000
+
+# Rank codes of the report (kraken2 reports), newer NCBI taxonomies name superkingdoms domains
+rank_codes = dict(map_lvls, domain='D')
+
+#Taxonomy Class
+#usage: NCBI taxonomy loaded into arrays indexed by taxid
+#   - parent: taxid of the parent (-1 for taxids not in nodes.dmp, root is its own parent)
+#   - rank: rank name of every taxid
+#   - name: scientific name of every taxid
+class Taxonomy(object):
+    'NCBI taxonomy as parent/rank/name arrays.'
+    def __init__(self, parent, rank, name):
+        self.parent = parent
+        self.rank = rank
+        self.name = name
+
+####################################################################
+# input_compression
+# usage: returns the pandas compression of a kraken2 output file
+#   (gzip, bzip2, xz or zstd are detected from the magic bytes, None for plain text)
+def input_compression(k_file):
+    curr_file = open(k_file, 'rb')
+    magic = curr_file.read(len(XZ_MAGIC))
+    curr_file.close()
+    if magic.startswith(GZIP_MAGIC):
+        return 'gzip'
+    if magic.startswith(BZIP2_MAGIC):
+        return 'bz2'
+    if magic.startswith(XZ_MAGIC):
+        return 'xz'
+    if magic.startswith(ZSTD_MAGIC):
+        return 'zstd'
+    return None
+
+####################################################################
+# count_output
+# usage: streams one kraken2 output file in chunks of lines and counts the
+#   reads assigned to every taxid with np.bincount, only the taxid column is parsed
+#   (runs in the worker processes with --threads)
+# input: tuple of kraken2 output filename and number of lines per chunk
+# returns:
+#   - taxids with at least one read (array, 0 = unclassified)
+#   - number of reads of every taxid (array)
+def count_output(job):
+    k_file, chunk_lines = job
+    counts = np.zeros(0, dtype=np.int64)
+    chunks = pd.read_csv(k_file, sep='\t', header=None, usecols=[2], quoting=3,
+        compression=input_compression(k_file), chunksize=chunk_lines)
+    for chunk in chunks:
+        taxids = chunk[2]
+        if not pd.api.types.is_integer_dtype(taxids):
+            # kraken2 --use-names: 'name (taxid X)'
+            taxids = taxids.astype(str).str.extract(r'\(taxid (\d+)\)\s*$', expand=False).fillna(taxids)
+        taxids = taxids.to_numpy(dtype=np.int64)
+        chunk_counts = np.bincount(taxids, minlength=len(counts))
+        chunk_counts[:len(counts)] += counts
+        counts = chunk_counts
+    taxids = np.flatnonzero(counts)
+    return taxids, counts[taxids]
+
+####################################################################
+# load_taxonomy
+# usage: loads nodes.dmp and names.dmp (fields separated by '\t|\t') into a Taxonomy
+#   only the scientific names are kept
+def load_taxonomy(nodes_file, names_file):
+    nodes = pd.read_csv(nodes_file, sep='\t', header=None, usecols=[0,2,4], quoting=3,
+        dtype={0: np.int64, 2: np.int64, 4: str})
+    names = pd.read_csv(names_file, sep='\t', header=None, usecols=[0,2,6], quoting=3,
+        dtype={0: np.int64, 2: str, 6: str}, keep_default_na=False)
+    names = names[names[6] == 'scientific name']
+    size = int(max(nodes[0].max(), names[0].max())) + 1
+    parent = np.full(size, -1, dtype=np.int64)
+    parent[nodes[0].to_numpy()] = nodes[2].to_numpy()
+    rank = np.full(size, 'no rank', dtype=object)
+    rank[nodes[0].to_numpy()] = nodes[4].to_numpy(dtype=object)
+    name = np.full(size, '', dtype=object)
+    name[names[0].to_numpy()] = names[2].to_numpy(dtype=object)
+    return Taxonomy(parent, rank, name)
+
+####################################################################
+# build_report
+# usage: builds the kraken report of one sample from its read counts per taxid
+#   the clade totals are summed up the lineages of all taxids with reads at once
+#   (one step per taxonomy level), taxa without reads are left out
+# input:
+#   - Taxonomy
+#   - taxids and their read counts (count_output)
+# returns:
+#   - list of report lines as returned by process_kraken_report (kraken2 order:
+#     unclassified, then depth-first from the root, children by decreasing reads)
+#   - number of reads assigned to taxids that are not in the taxonomy (counted at the root)
+def build_report(taxonomy, taxids, counts):
+    report = []
+    classified = taxids != 0
+    u_count = int(counts[~classified].sum())
+    if u_count > 0:
+        report.append(['unclassified', '0', 0, 'U', u_count, u_count])
+    taxids = taxids[classified]
+    counts = counts[classified]
+    # Taxids missing from the taxonomy (e.g. a newer kraken2 database)
+    missing = (taxids >= len(taxonomy.parent)) | (taxids < 0)
+    missing[~missing] = taxonomy.parent[taxids[~missing]] < 0
+    num_missing = int(counts[missing].sum())
+    if missing.any():
+        taxids, inverse = np.unique(np.append(taxids[~missing], 1), return_inverse=True)
+        counts = np.bincount(inverse, weights=np.append(counts[~missing], num_missing)).astype(np.int64)
+    if len(taxids) == 0:
+        return report, num_missing
+    # Every read counts for all taxa of its lineage
+    nodes = []
+    weights = []
+    curr_ids = taxids
+    curr_counts = counts
+    while len(curr_ids) > 0:
+        nodes.append(curr_ids)
+        weights.append(curr_counts)
+        below_root = curr_ids != 1
+        curr_ids = taxonomy.parent[curr_ids[below_root]]
+        curr_counts = curr_counts[below_root]
+    clade_ids, inverse = np.unique(np.concatenate(nodes), return_inverse=True)
+    clade_reads = np.bincount(inverse, weights=np.concatenate(weights)).astype(np.int64)
+    level_reads = dict(zip(taxids.tolist(), counts.tolist()))
+    # Children of every taxon, sorted by decreasing reads (then taxid)
+    parents = taxonomy.parent[clade_ids]
+    order = np.lexsort((clade_ids, -clade_reads, parents))
+    children = {}
+    for taxid, parent, reads in zip(clade_ids[order].tolist(), parents[order].tolist(),
+            clade_reads[order].tolist()):
+        if taxid != 1:
+            children.setdefault(parent, []).append((taxid, reads))
+    # Depth-first from the root, ranks without a code are numbered below the
+    # last ranked taxon (e.g. R -> R1, S -> S1 -> S2)
+    all_nodes = [(1, int(clade_reads[np.searchsorted(clade_ids, 1)]), 0, 'R', -1)]
+    while len(all_nodes) > 0:
+        taxid, reads, level_num, rank_code, rank_num = all_nodes.pop()
+        rank = taxonomy.rank[taxid]
+        if rank in rank_codes:
+            rank_code = rank_codes[rank]
+            rank_num = 0
+        else:
+            rank_num += 1
+        level_id = rank_code + (str(rank_num) if rank_num > 0 else '')
+        report.append([taxonomy.name[taxid], str(taxid), level_num, level_id, reads, level_reads.get(taxid, 0)])
+        for child, child_reads in reversed(children.get(taxid, [])):
+            all_nodes.append((child, child_reads, level_num + 1, rank_code, rank_num))
+    return report, num_missing
+
+####################################################################
+# Main method
+def main():
+    # Parse arguments
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-k','--kraken-output','--kraken-outputs', required=True,dest='k_files',nargs='+',
+        help='Input kraken2 output files (--output of kraken2, one line per read) to combine (separate by spaces)')
+    parser.add_argument('--taxonomy',required=False,dest='taxonomy',
+        default=None,
+        help='Directory with the NCBI taxonomy files nodes.dmp and names.dmp (e.g. taxonomy/ of the kraken2 database)')
+    parser.add_argument('--nodes',required=False,dest='nodes',
+        default=None,
+        help='NCBI taxonomy nodes.dmp [default: nodes.dmp in --taxonomy]')
+    parser.add_argument('--names',required=False,dest='names',
+        default=None,
+        help='NCBI taxonomy names.dmp [default: names.dmp in --taxonomy]')
+    parser.add_argument('-o','--output', required=True,dest='output',
+        help='Output kraken report file with combined information')
+    parser.add_argument('--sample-names',required=False,nargs='+',
+        dest='s_names',default=[],help='Sample names to use as headers in the new report')
+    parser.add_argument('-t','--threads','--processes',required=False,dest='processes',
+        type=int, default=1,
+        help='Number of worker processes used to count the reads [default 1]')
+    parser.add_argument('--chunk-lines',required=False,dest='chunk_lines',
+        type=int, default=CHUNK_LINES,
+        help='Number of lines of a kraken2 output file counted at once [default %i]' % CHUNK_LINES)
+    add_output_args(parser)
+    args=parser.parse_args()
+
+    # Initialize combined values
+    count_samples = 0
+    num_samples = len(args.k_files)
+    if args.s_names:
+        sample_names = args.s_names
+    else:
+        sample_names = []
+        for k_file in args.k_files:
+            sample_names.append(sample_name(k_file))
+    u_reads = {0:0}
+    taxid2node = {}
+    counts = CountMatrix(num_samples) if args.compact else None
+
+    # Check input values
+    if len(sample_names) != num_samples:
+        sys.stderr.write("Number of sample names provided does not match number of kraken2 output files\n")
+        sys.exit(1)
+    nodes_file = args.nodes
+    names_file = args.names
+    if args.taxonomy is not None:
+        if nodes_file is None:
+            nodes_file = os.path.join(args.taxonomy, 'nodes.dmp')
+        if names_file is None:
+            names_file = os.path.join(args.taxonomy, 'names.dmp')
+    if nodes_file is None or names_file is None:
+        sys.stderr.write("The taxonomy is required: give --taxonomy or --nodes and --names\n")
+        sys.exit(1)
+    # Taxa to read and write
+    taxon_filter = make_taxon_filter(args)
+
+    #################################################
+    # STEP 0: READ TAXONOMY
+    sys.stdout.write(">>STEP 0: READING TAXONOMY %s %s\n" % (nodes_file, names_file))
+    taxonomy = load_taxonomy(nodes_file, names_file)
+
+    #################################################
+    # STEP 1: COUNT READS
+    # Output files are counted independently (in worker processes with --threads)
+    # and added to the tree in input order, so the result does not depend
+    # on the number of processes
+    sys.stdout.write(">>STEP 1: COUNTING READS\n")
+    sys.stdout.write("\t%i/%i samples processed" % (count_samples, num_samples))
+    sys.stdout.flush()
+    jobs = [(k_file, args.chunk_lines) for k_file in args.k_files]
+    if args.processes > 1:
+        pool = Pool(args.processes)
+        results = pool.imap(count_output, jobs)
+    else:
+        pool = None
+        results = map(count_output, jobs)
+    for k_file, (taxids, reads) in zip(args.k_files, results):
+        count_samples += 1
+        report, num_missing = build_report(taxonomy, taxids, reads)
+        if num_missing > 0:
+            sys.stderr.write("\n%i reads of %s are assigned to taxids missing from the taxonomy, counted at the root\n"
+                % (num_missing, k_file))
+        if taxon_filter is not None:
+            report = taxon_filter.filter_report(report)
+        add_report(count_samples, report, taxid2node, u_reads, counts)
+        sys.stdout.write("\r\t%i/%i samples processed" % (count_samples, num_samples))
+        sys.stdout.flush()
+    if pool is not None:
+        pool.close()
+        pool.join()
+    if '1' not in taxid2node:
+        taxid2node['1'] = new_node(taxonomy.name[1], '1', 0, 'R', None, counts)
+    if counts is not None:
+        counts.finalize()
+    sys.stdout.write("\r\t%i/%i samples processed\n" % (count_samples, num_samples))
+    sys.stdout.flush()
+
+    # Lines mapping sample ids to filenames
+    header = "#Number of Samples: %i\n" % num_samples
+    for s_name, k_file in zip(sample_names, args.k_files):
+        header += "#%s\t%s\n" % (s_name, k_file)
+    write_combined(args, sample_names, header, u_reads, taxid2node['1'], num_samples, taxon_filter)
+
+####################################################################
+if __name__ == "__main__":
+    main()
@@ -19,13 +19,39 @@
 #
 # Parameters:
 #   -h, --help................show help message.
-#   -r X, --report-file X.....all input kraken reports (separated by spaces)
+#   -r X, --report-file X.....all input kraken reports (separated by spaces), plain text or
+#                             compressed with gzip, bzip2, xz or zstd (detected from the file)
 #   -o X, --output X..........output kraken report filename
 #   --sample-names............sample names for each kraken report (separated by spaces)
 #                             [if none are given, each sample named from input report file name]
 #   --bracken..................Set this for bracken input - omits representation of unclassified fraction
 #   --single-tax-level........Set this to create single tables for each major taxonomic level 
 #                             in addition to overall merged report
+#   -t X, --threads X.........number of worker processes used to parse the reports [default 1]
+#   --compact.................Set this to keep read counts in a sparse taxa x samples matrix
+#                             instead of per-node dictionaries (lower memory for many samples)
+#   --tax-level-container X...write the tables for each major taxonomic level into one container:
+#                             X.npz (numpy) or a directory X with one Parquet file per level
+#   --streaming...............Set this for a low-memory k-way merge of the reports; the taxa are
+#                             written in taxonomic (taxid lineage) order instead of by read counts
+#   --tmp-dir X...............directory for the sorted intermediate files of --streaming
+#   --append-to X.............existing combined report to which the samples of the input reports
+#                             are added as new columns (-o may be the same file)
+#   --cache-dir X.............directory for binary caches of parsed reports (.kcache), reports
+#                             that were parsed before (same path, mtime, size and content) are
+#                             loaded from the cache instead
+#   --cache-size X............maximum size of the cache directory in MB, least recently used
+#                             entries are removed [default 1024]
+#   --ranks X.................only write taxa of these levels (e.g. U R P G S), levels below the
+#                             lowest given level are not read at all
+#   --min-reads X.............only write taxa with at least X reads (incl. lower levels) ...
+#   --min-samples X.............. in at least X samples [default 1]
+#   --taxid-include X.........only keep these taxa with their lineage and everything below them
+#   --taxid-exclude X.........remove these taxa and everything below them
+#   --format X................output format of the combined report(s) [default tsv]
+#                             tsv, tsv.gz, tsv.zst (zstandard), parquet (pyarrow: taxid, rank,
+#                             name, one column per sample), mtx (sparse Matrix Market matrix
+#                             with X.rows.tsv and X.samples.tsv) or npz (sparse CSR matrix, numpy)
 # Each Input report file format (tab-delimited)
 #   - percentage of total reads
 #   - number of reads (including reads within subtree)
@@ -40,13 +66,96 @@
 #   - name of level
 # Methods 
 #   - main
+#   - combine_reports
 #   - process_kraken_report
+#   - report_chunks
+#   - read_report_columns
+#   - parse_report_block
+#   - read_report
+#   - load_report
+#   - report_columns
+#   - cache_key
+#   - file_digest
+#   - load_cached_report
+#   - save_cached_report
+#   - prune_cache
+#   - add_report
+#   - add_report_lines
+#   - new_node
+#   - rank_depth
+#   - valid_rank
+#   - expand_reads
+#   - derive_level_id
+#   - read_combined_report
+#   - report_header
+#   - open_writer
+#   - raise_open_files_limit
+#   - write_node
+#   - print_tree
+#   - spool_report
+#   - read_spool
+#   - merge_spool_rows
+#   - reduce_spools
+#   - merge_spools
+#   - write_spooled_node
+#   - sample_name
+#   - split_values
+#   - add_output_args
+#   - make_taxon_filter
+#   - write_combined
 ####################################################################
 import os, sys, argparse
+import bz2
+import codecs
+import gc
+import gzip
+import hashlib
+import io
+import lzma
+import queue
+import threading
+import heapq
 import operator
+import shutil
+import struct
+import tempfile
+from array import array
+from functools import partial
+from itertools import repeat
+from multiprocessing import Pool
 from time import gmtime 
 from time import strftime 
 
+# Buffer size of the output files
+WRITE_BUFFER = 1 << 20
+
+# Output formats of the combined report(s)
+OUTPUT_FORMATS = ['tsv', 'tsv.gz', 'tsv.zst', 'parquet', 'mtx', 'npz']
+
+# Number of rows per Parquet row group
+PARQUET_ROWS = 10000
+
+# Compressed input reports: magic bytes and size of decompressed chunks
+GZIP_MAGIC = b'\x1f\x8b'
+BZIP2_MAGIC = b'BZh'
+XZ_MAGIC = b'\xfd7zXZ\x00'
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+READ_CHUNK = 1 << 22
+# Suffixes of compressed input files, not part of the default sample names
+COMPRESSED_SUFFIXES = ['.gz', '.bz2', '.xz', '.zst', '.zstd']
+READ_QUEUE = 4
+
+# Open files kept free for the output files while merging the intermediate
+# files of --streaming
+SPOOL_MARGIN = 32
+
+# Header of the binary report caches (--cache-dir)
+KCACHE_MAGIC = b'KCACHE1\n'
+
+# Taxonomic levels
+main_lvls = ['U','R','D','K','P','C','O','F','G','S']
+map_lvls = {'kingdom':'K', 'superkingdom':'D','phylum':'P','class':'C','order':'O','family':'F','genus':'G','species':'S'}
+
 #Tree Class 
 #usage: tree node used in constructing a taxonomy tree
 #   including only the taxonomy levels and genomes identified in the Kraken report
@@ -74,9 +183,414 @@ class Tree(object):
         self.lvl_reads[sample] = lvl_reads
         self.tot_all += all_reads
         self.tot_lvl += lvl_reads
+    def sample_reads(self, num_samples):
+        return [self.all_reads.get(i+1, 0) for i in range(num_samples)]
     def __lt__(self,other):
         return self.tot_all < other.tot_all
-         
+
+#CountMatrix Class
+#usage: sparse taxa x samples matrix of read counts (all reads) used with --compact
+#   counts are collected as (node id, sample, reads) triplets while reading the
+#   reports and converted to compressed rows (CSR) by finalize() before printing
+class CountMatrix(object):
+    'Sparse taxa x samples read counts.'
+    def __init__(self, num_samples):
+        self.num_samples = num_samples
+        self.tot_all = array('q')
+        self.row_ids = array('l')
+        self.col_ids = array('l')
+        self.values = array('q')
+        self.indptr = None
+    def add_node(self, tot_all=0):
+        self.tot_all.append(tot_all)
+        return len(self.tot_all) - 1
+    def add_reads(self, node_id, sample, all_reads):
+        self.row_ids.append(node_id)
+        self.col_ids.append(sample - 1)
+        self.values.append(all_reads)
+        self.tot_all[node_id] += all_reads
+    def finalize(self):
+        # Stable counting sort of the triplets by node id, keeps sample order per row
+        num_nodes = len(self.tot_all)
+        indptr = array('l', [0]) * (num_nodes + 1)
+        for node_id in self.row_ids:
+            indptr[node_id + 1] += 1
+        for i in range(num_nodes):
+            indptr[i + 1] += indptr[i]
+        fill = array('l', indptr)
+        col_ids = array('l', [0]) * len(self.values)
+        values = array('q', [0]) * len(self.values)
+        for node_id, col, val in zip(self.row_ids, self.col_ids, self.values):
+            pos = fill[node_id]
+            col_ids[pos] = col
+            values[pos] = val
+            fill[node_id] = pos + 1
+        self.indptr = indptr
+        self.col_ids = col_ids
+        self.values = values
+        self.row_ids = None
+    def row(self, node_id):
+        counts = [0] * self.num_samples
+        for pos in range(self.indptr[node_id], self.indptr[node_id + 1]):
+            counts[self.col_ids[pos]] = self.values[pos]
+        return counts
+
+#CompactNode Class
+#usage: structure-only tree node used with --compact
+#   read counts are stored in a shared CountMatrix row given by node_id
+class CompactNode(object):
+    'Structure-only tree node.'
+    __slots__ = ('name', 'taxid', 'level_num', 'level_id', 'node_id', 'counts', 'children', 'parent')
+    def __init__(self, name, taxid, level_num, level_id, counts, parent=None, tot_all=0):
+        self.name = name
+        self.taxid = taxid
+        self.level_num = level_num
+        self.level_id = level_id
+        self.counts = counts
+        self.node_id = counts.add_node(tot_all)
+        self.children = []
+        self.parent = parent
+    def add_child(self,node):
+        assert isinstance(node,CompactNode)
+        self.children.append(node)
+    def add_reads(self, sample, all_reads, lvl_reads):
+        self.counts.add_reads(self.node_id, sample, all_reads)
+    def sample_reads(self, num_samples):
+        return self.counts.row(self.node_id)
+    def __lt__(self,other):
+        return self.counts.tot_all[self.node_id] < self.counts.tot_all[other.node_id]
+
+#ReportWriter Class
+#usage: buffered writer for a tab-delimited (combined) kraken report
+#   (plain text, gzip or zstandard compressed)
+#   every row is formatted completely and written with a single call
+#   (with --append-to the first element of reads holds the already formatted
+#   counts of the existing samples)
+class ReportWriter(object):
+    'Tab-delimited report writer.'
+    def __init__(self, filename, sample_names, comments='', fmt='tsv'):
+        if fmt == 'tsv.gz':
+            self.o_file = gzip.open(filename, 'wt', compresslevel=6)
+        elif fmt == 'tsv.zst':
+            try:
+                import zstandard
+            except ImportError:
+                sys.stderr.write("--format tsv.zst requires zstandard to be installed\n")
+                sys.exit(1)
+            self.o_file = io.TextIOWrapper(zstandard.ZstdCompressor().stream_writer(
+                open(filename, 'wb', buffering=WRITE_BUFFER)))
+        else:
+            self.o_file = open(filename, 'w', buffering=WRITE_BUFFER)
+        self.o_file.write(comments + report_header(sample_names))
+    def write_row(self, reads, level_id, taxid, level_num, name):
+        self.o_file.write("%s\t%s\t%s\t%s%s\n" % ("\t".join(map(str, reads)),
+            level_id, taxid, " "*level_num*2, name))
+    def close(self):
+        self.o_file.close()
+
+#ParquetReportWriter Class
+#usage: writer for a combined report in Parquet format (--format parquet)
+#   columns taxid, rank, name and one column of reads per sample, the
+#   header lines are kept in the file metadata; rows are written in groups
+class ParquetReportWriter(object):
+    'Parquet report writer.'
+    def __init__(self, filename, sample_names, comments=''):
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            sys.stderr.write("--format parquet requires pyarrow to be installed\n")
+            sys.exit(1)
+        self.pa = pyarrow
+        self.sample_names = sample_names
+        fields = [('taxid', pyarrow.int64()), ('rank', pyarrow.string()), ('name', pyarrow.string())]
+        fields += [(sample, pyarrow.int64()) for sample in sample_names]
+        self.schema = pyarrow.schema(fields, metadata={'header': comments})
+        self.writer = pyarrow.parquet.ParquetWriter(filename, self.schema)
+        self.rows = []
+    def write_row(self, reads, level_id, taxid, level_num, name):
+        self.rows.append((int(taxid), level_id, name, expand_reads(reads)))
+        if len(self.rows) >= PARQUET_ROWS:
+            self.flush()
+    def flush(self):
+        if len(self.rows) == 0:
+            return
+        columns = [[row[0] for row in self.rows], [row[1] for row in self.rows],
+            [row[2] for row in self.rows]]
+        columns += [list(column) for column in zip(*[row[3] for row in self.rows])]
+        self.writer.write_table(self.pa.Table.from_arrays(columns, schema=self.schema))
+        self.rows = []
+    def close(self):
+        self.flush()
+        self.writer.close()
+
+#SparseReportWriter Class
+#usage: writer for the read counts of a combined report as sparse taxa x samples
+#   matrix, most counts of large cohorts are zero
+#   - mtx: Matrix Market coordinate file (header lines as % comments) with the
+#     taxa in X.rows.tsv (taxid, rank, name) and the samples in X.samples.tsv
+#   - npz: CSR matrix as written by scipy.sparse.save_npz (data, indices, indptr,
+#     shape, format) plus the arrays taxid, rank, name and samples (numpy)
+class SparseReportWriter(object):
+    'Sparse matrix report writer.'
+    def __init__(self, filename, sample_names, comments='', fmt='mtx'):
+        self.filename = filename
+        self.fmt = fmt
+        self.sample_names = sample_names
+        self.num_rows = 0
+        self.num_values = 0
+        if fmt == 'npz':
+            try:
+                import numpy
+            except ImportError:
+                sys.stderr.write("--format npz requires numpy to be installed\n")
+                sys.exit(1)
+            self.taxids = array('q')
+            self.ranks = []
+            self.names = []
+            self.indptr = array('q', [0])
+            self.indices = array('l')
+            self.values = array('q')
+        else:
+            self.o_file = open(filename, 'wb', buffering=WRITE_BUFFER)
+            self.o_file.write(b"%%MatrixMarket matrix coordinate integer general\n")
+            for line in comments.splitlines():
+                self.o_file.write(("%" + line + "\n").encode())
+            # Size line is filled in when all rows are written
+            self.size_pos = self.o_file.tell()
+            self.o_file.write(b" " * 63 + b"\n")
+            self.row_file = open(filename + '.rows.tsv', 'w', buffering=WRITE_BUFFER)
+            self.row_file.write("taxid\trank\tname\n")
+    def write_row(self, reads, level_id, taxid, level_num, name):
+        reads = expand_reads(reads)
+        nonzero = [i for i in range(len(reads)) if reads[i] != 0]
+        if self.fmt == 'npz':
+            self.taxids.append(int(taxid))
+            self.ranks.append(level_id)
+            self.names.append(name)
+            self.indices.extend(nonzero)
+            self.values.extend([reads[i] for i in nonzero])
+            self.indptr.append(len(self.indices))
+        else:
+            self.num_rows += 1
+            self.o_file.write("".join(["%i %i %i\n" % (self.num_rows, i+1, reads[i])
+                for i in nonzero]).encode())
+            self.row_file.write("%s\t%s\t%s\n" % (taxid, level_id, name))
+        self.num_values += len(nonzero)
+    def close(self):
+        if self.fmt == 'npz':
+            import numpy as np
+            # file object, numpy would add .npz to names like X-S
+            o_file = open(self.filename, 'wb')
+            np.savez_compressed(o_file,
+                data=np.frombuffer(self.values, dtype=np.int64),
+                indices=np.frombuffer(self.indices, dtype=np.int64),
+                indptr=np.frombuffer(self.indptr, dtype=np.int64),
+                shape=np.array([len(self.names), len(self.sample_names)]),
+                format=np.array('csr'),
+                taxid=np.frombuffer(self.taxids, dtype=np.int64),
+                rank=np.array(self.ranks, dtype=str), name=np.array(self.names, dtype=str),
+                samples=np.array(self.sample_names, dtype=str))
+            o_file.close()
+            return
+        self.o_file.seek(self.size_pos)
+        self.o_file.write(("%i %i %i" % (self.num_rows, len(self.sample_names),
+            self.num_values)).encode())
+        self.o_file.close()
+        self.row_file.close()
+        s_file = open(self.filename + '.samples.tsv', 'w')
+        for sample in self.sample_names:
+            s_file.write("%s\n" % sample)
+        s_file.close()
+
+#LevelTables Class
+#usage: collects the rows of every major taxonomic level and writes them into
+#   one container instead of separate text reports (--tax-level-container)
+#   - X.npz: arrays <level>_taxid, <level>_name and <level>_reads (taxa x samples),
+#     plus samples and unclassified (reads of every sample)
+#   - otherwise: directory X with one <level>.parquet table (taxid, name, samples...),
+#     plus unclassified.parquet with the one row of taxid 0
+#   (the unclassified reads are only stored if the report has the row, not with --bracken)
+class LevelTables(object):
+    'Per-level tables written to a npz or Parquet container.'
+    def __init__(self, path, sample_names, levels):
+        self.path = path
+        self.sample_names = sample_names
+        self.rows = {}
+        for level in levels:
+            self.rows[level] = []
+        self.unclassified = None
+        try:
+            if path.endswith('.npz'):
+                import numpy
+            else:
+                import pandas
+                import pyarrow
+        except ImportError as err:
+            sys.stderr.write("--tax-level-container %s requires %s to be installed\n" % (path, err.name))
+            sys.exit(1)
+    def write_row(self, reads, level_id, taxid, level_num, name):
+        reads = expand_reads(reads)
+        if level_id == 'U':
+            self.unclassified = reads
+        else:
+            self.rows[level_id].append((int(taxid), name, reads))
+    def close(self):
+        if self.path.endswith('.npz'):
+            import numpy as np
+            tables = {'samples': np.array(self.sample_names)}
+            if self.unclassified is not None:
+                tables['unclassified'] = np.array(self.unclassified, dtype=np.int64)
+            for level in self.rows:
+                rows = self.rows[level]
+                tables[level + '_taxid'] = np.array([row[0] for row in rows], dtype=np.int64)
+                tables[level + '_name'] = np.array([row[1] for row in rows], dtype=str)
+                tables[level + '_reads'] = np.array([row[2] for row in rows],
+                    dtype=np.int64).reshape(len(rows), len(self.sample_names))
+            np.savez_compressed(self.path, **tables)
+        else:
+            import pandas as pd
+            os.makedirs(self.path, exist_ok=True)
+            tables = {}
+            if self.unclassified is not None:
+                tables['unclassified'] = [(0, 'unclassified', self.unclassified)]
+            tables.update(self.rows)
+            for level in tables:
+                rows = tables[level]
+                table = pd.DataFrame([row[2] for row in rows], columns=self.sample_names, dtype='int64')
+                table.insert(0, 'name', [row[1] for row in rows])
+                table.insert(0, 'taxid', pd.array([row[0] for row in rows], dtype='int64'))
+                table.to_parquet(os.path.join(self.path, level + '.parquet'), index=False)
+
+#PausedGC Class
+#usage: with-block that turns off the cyclic garbage collector, used while
+#   parsing a report and adding it to the tree: the new strings and nodes stay
+#   alive anyway, the collector would only scan them again and again
+class PausedGC(object):
+    'Pauses the garbage collector.'
+    def __enter__(self):
+        self.enabled = gc.isenabled()
+        gc.disable()
+        return self
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.enabled:
+            gc.enable()
+        return False
+
+#ThreadedReader Class
+#usage: reads (and decompresses) a binary stream in a background thread,
+#   the chunks are passed on through a bounded queue so that decompression
+#   overlaps with parsing in the main thread
+class ThreadedReader(object):
+    'Background reader of a binary stream.'
+    def __init__(self, stream):
+        self.queue = queue.Queue(maxsize=READ_QUEUE)
+        self.thread = threading.Thread(target=self.run, args=(stream,))
+        self.thread.daemon = True
+        self.thread.start()
+    def run(self, stream):
+        try:
+            chunk = stream.read(READ_CHUNK)
+            while chunk:
+                self.queue.put(chunk)
+                chunk = stream.read(READ_CHUNK)
+            self.queue.put(None)
+        except Exception as err:
+            self.queue.put(err)
+        finally:
+            stream.close()
+    def __iter__(self):
+        while True:
+            chunk = self.queue.get()
+            if chunk is None:
+                break
+            if isinstance(chunk, Exception):
+                raise chunk
+            yield chunk
+
+#TaxonFilter Class
+#usage: selects the taxa that are read and written (--ranks, --min-reads,
+#   --min-samples, --taxid-include, --taxid-exclude)
+#   - filter_report drops lines while parsing: excluded subtrees, everything
+#     outside of included subtrees (except their lineage) and levels below the
+#     lowest requested rank
+#   - descend/write_level/keep_reads are used while walking the combined tree,
+#     subtrees of taxa with too few reads are skipped completely
+class TaxonFilter(object):
+    'Taxon selection for reading and writing reports.'
+    def __init__(self, ranks=None, min_reads=0, min_samples=1, include=None, exclude=None):
+        self.ranks = set(ranks) if ranks else None
+        self.max_depth = max(map(rank_depth, self.ranks)) if self.ranks else None
+        self.min_reads = min_reads
+        self.min_samples = min_samples
+        self.include = set(include) if include else None
+        self.exclude = set(exclude) if exclude else None
+    def filter_report(self, report):
+        kept = []
+        skip_level = None
+        lineage = []
+        in_level = None
+        for report_vals in report:
+            [name, taxid, level_num, level_type, all_reads, level_reads] = report_vals
+            # Below a removed taxon
+            if skip_level is not None:
+                if level_num > skip_level:
+                    continue
+                skip_level = None
+            if level_type in map_lvls:
+                level_type = map_lvls[level_type]
+            if level_type == 'U' or taxid == '0':
+                kept.append(report_vals)
+                continue
+            # The root is always kept (it is only filtered when writing)
+            if taxid == '1':
+                kept.append(report_vals)
+                if self.exclude is not None and taxid in self.exclude:
+                    skip_level = level_num
+                continue
+            if self.exclude is not None and taxid in self.exclude:
+                skip_level = level_num
+                continue
+            if (self.max_depth is not None and level_type != '-'
+                    and rank_depth(level_type) > self.max_depth):
+                skip_level = level_num
+                continue
+            if self.include is None:
+                kept.append(report_vals)
+                continue
+            # Inside an included subtree
+            if in_level is not None:
+                if level_num > in_level:
+                    kept.append(report_vals)
+                    continue
+                in_level = None
+            # Keep the lineage of included taxa (added when a taxon is included)
+            while len(lineage) > 0 and lineage[-1][0][2] >= level_num:
+                lineage.pop()
+            if taxid in self.include:
+                for entry in lineage:
+                    if not entry[1]:
+                        kept.append(entry[0])
+                        entry[1] = True
+                kept.append(report_vals)
+                in_level = level_num
+            lineage.append([report_vals, taxid in self.include])
+        return kept
+    def descend(self, level_id):
+        return self.max_depth is None or rank_depth(level_id) < self.max_depth
+    def write_level(self, level_id):
+        return self.ranks is None or level_id in self.ranks
+    def keep_reads(self, reads):
+        if self.min_reads <= 0:
+            return True
+        num_samples = 0
+        for i in expand_reads(reads):
+            if i >= self.min_reads:
+                num_samples += 1
+                if num_samples >= self.min_samples:
+                    return True
+        return False
+
 ####################################################################
 # process_kraken_report
 # usage: parses a single line in the kraken report and extracts relevant information
@@ -120,7 +634,781 @@ def process_kraken_report(curr_str):
     #Determine which level based on number of spaces
     level_num = int(spaces/2)
     return [name, taxid, level_num, level_type, all_reads, level_reads]
-    
+
+####################################################################
+# report_chunks
+# usage: iterates over the text of a (combined) report in blocks of complete lines
+#   plain text files are read at once, gzip, bzip2, xz and zstd compressed files
+#   (detected by their magic bytes) are decompressed while streaming in a
+#   ThreadedReader, no uncompressed copy is written
+# input: report filename
+# returns (per block):
+#   - text of complete lines
+def report_chunks(r_file):
+    curr_file = open(r_file, 'rb')
+    magic = curr_file.read(len(XZ_MAGIC))
+    curr_file.close()
+    if magic.startswith(GZIP_MAGIC):
+        stream = gzip.open(r_file, 'rb')
+    elif magic.startswith(BZIP2_MAGIC):
+        stream = bz2.open(r_file, 'rb')
+    elif magic.startswith(XZ_MAGIC):
+        stream = lzma.open(r_file, 'rb')
+    elif magic.startswith(ZSTD_MAGIC):
+        try:
+            import zstandard
+        except ImportError:
+            sys.stderr.write("Reading zstd compressed report %s requires zstandard to be installed\n" % r_file)
+            sys.exit(1)
+        stream = zstandard.ZstdDecompressor().stream_reader(open(r_file, 'rb'), closefd=True)
+    else:
+        curr_file = open(r_file, 'r')
+        data = curr_file.read()
+        curr_file.close()
+        yield data
+        return
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    rest = ''
+    for chunk in ThreadedReader(stream):
+        data = rest + decoder.decode(chunk)
+        end = data.rfind('\n') + 1
+        rest = data[end:]
+        if end > 0:
+            yield data[:end]
+    rest += decoder.decode(b'', True)
+    if rest:
+        yield rest
+
+####################################################################
+# read_report_columns
+# usage: bulk parser for a whole kraken report, same result as calling
+#   process_kraken_report on every line but the file is read at once (or in
+#   large blocks if compressed) and every column is converted in one step
+# input: kraken report filename
+# returns (columns of all valid lines):
+#   - classification/genome names, taxonomy IDs, level numbers, level names,
+#     all reads (array), reads only at this level (array)
+def read_report_columns(r_file):
+    columns = None
+    with PausedGC():
+        for data in report_chunks(r_file):
+            block = parse_report_block(data)
+            if columns is None:
+                columns = block
+            else:
+                for column, values in zip(columns, block):
+                    column.extend(values)
+    if columns is None:
+        return [], [], [], [], array('q'), array('q')
+    return columns
+
+####################################################################
+# parse_report_block
+# usage: converts complete lines of a kraken report into columns
+#   (no per-line function calls and the indentation is taken from the
+#   length of the left-stripped names)
+#   if all lines have the six report columns, the columns are sliced
+#   directly from the tab-split text
+# returns: columns as read_report_columns
+def parse_report_block(data):
+    lines = data.split('\n')
+    if len(lines) > 0 and lines[-1] == '':
+        lines.pop()
+    columns = None
+    if set(map(str.count, lines, repeat('\t'))) == {5}:
+        fields = data.replace('\n', '\t').split('\t')
+        try:
+            columns = [fields[5::6], fields[4::6], fields[3::6],
+                array('q', map(int, fields[1::6])), array('q', map(int, fields[2::6]))]
+        except ValueError:
+            # e.g. header lines
+            columns = None
+        raw_names = list(map(str.rstrip, columns[0])) if columns is not None else None
+    if columns is None:
+        split_strs = [line.strip().split('\t') for line in lines]
+        split_strs = [split_str for split_str in split_strs
+            if len(split_str) >= 5 and split_str[1].isdigit()]
+        raw_names = list(map(operator.itemgetter(-1), split_strs))
+        columns = [raw_names, list(map(operator.itemgetter(4), split_strs)),
+            list(map(operator.itemgetter(3), split_strs)),
+            array('q', map(int, map(operator.itemgetter(1), split_strs))),
+            array('q', map(int, map(operator.itemgetter(2), split_strs)))]
+    [_, taxids, level_types, all_reads, level_reads] = columns
+    # Level numbers from the number of leading spaces
+    names = list(map(str.lstrip, raw_names, repeat(' ')))
+    spaces = map(operator.sub, map(len, raw_names), map(len, names))
+    level_nums = list(map(operator.floordiv, spaces, repeat(2)))
+    return [names, taxids, level_nums, level_types, all_reads, level_reads]
+
+####################################################################
+# read_report
+# usage: parses all lines of a single kraken report
+#   (runs in the worker processes with --threads)
+#   with a cache directory the parsed report is loaded from / saved to a .kcache file
+# input:
+#   - kraken report filename
+#   - cache directory (--cache-dir) or None
+# returns:
+#   - columns of the parsed lines as returned by read_report_columns
+#     (zip(*columns) gives the lines as returned by process_kraken_report)
+def read_report(r_file, cache_dir=None):
+    if cache_dir is not None:
+        cache_name = os.path.join(cache_dir, cache_key(r_file) + '.kcache')
+        digest = file_digest(r_file)
+        columns = load_cached_report(cache_name, digest)
+        if columns is not None:
+            return columns
+    columns = read_report_columns(r_file)
+    if cache_dir is not None:
+        save_cached_report(cache_name, digest, columns)
+    return columns
+
+####################################################################
+# load_report
+# usage: parses a kraken report (read_report) and applies the TaxonFilter
+#   (runs in the worker processes with --threads, the columns are passed
+#   back to the main process instead of one tuple per line)
+def load_report(r_file, cache_dir=None, taxon_filter=None):
+    columns = read_report(r_file, cache_dir)
+    if taxon_filter is not None:
+        columns = report_columns(taxon_filter.filter_report(zip(*columns)))
+    return columns
+
+####################################################################
+# report_columns
+# usage: converts parsed report lines back into columns (see read_report_columns)
+def report_columns(report):
+    columns = list(zip(*report))
+    if len(columns) == 0:
+        return [], [], [], [], array('q'), array('q')
+    return [list(columns[0]), list(columns[1]), list(columns[2]), list(columns[3]),
+        array('q', columns[4]), array('q', columns[5])]
+
+####################################################################
+# cache_key
+# usage: returns the name of the cache entry for a report, made from its
+#   absolute path, modification time and size
+def cache_key(r_file):
+    stat = os.stat(r_file)
+    key = "%s\t%i\t%i" % (os.path.abspath(r_file), stat.st_mtime_ns, stat.st_size)
+    return hashlib.sha1(key.encode()).hexdigest()
+
+####################################################################
+# file_digest
+# usage: returns the SHA-1 digest of the file content, stored in the cache
+#   entry so that a report rewritten with the same size and time is not reused
+def file_digest(r_file):
+    digest = hashlib.sha1()
+    curr_file = open(r_file, 'rb')
+    chunk = curr_file.read(WRITE_BUFFER)
+    while chunk:
+        digest.update(chunk)
+        chunk = curr_file.read(WRITE_BUFFER)
+    curr_file.close()
+    return digest.digest()
+
+####################################################################
+# load_cached_report
+# usage: loads a parsed report from a .kcache file
+#   (layout: magic, content digest, number of lines n, n all reads, n level
+#   reads, n level numbers, then taxids, level types and names as text)
+# returns:
+#   - columns as returned by read_report_columns
+#     or None if there is no valid cache entry for this content
+def load_cached_report(cache_name, digest):
+    try:
+        c_file = open(cache_name, 'rb')
+    except OSError:
+        return None
+    data = c_file.read()
+    c_file.close()
+    if data[:len(KCACHE_MAGIC)] != KCACHE_MAGIC:
+        return None
+    pos = len(KCACHE_MAGIC)
+    if data[pos:pos+len(digest)] != digest:
+        return None
+    pos += len(digest)
+    num_lines = struct.unpack_from('<q', data, pos)[0]
+    pos += 8
+    columns = []
+    for typecode in ['q', 'q', 'i']:
+        column = array(typecode)
+        end = pos + num_lines * column.itemsize
+        column.frombytes(data[pos:end])
+        columns.append(column)
+        pos = end
+    all_reads, level_reads, level_nums = columns
+    taxids, level_types, names = data[pos:].decode().split('\0')
+    # LRU: mark the entry as used
+    os.utime(cache_name)
+    if num_lines == 0:
+        return [], [], [], [], all_reads, level_reads
+    return (names.split('\n'), taxids.split('\n'), list(level_nums),
+        level_types.split('\n'), all_reads, level_reads)
+
+####################################################################
+# save_cached_report
+# usage: writes the columns of a parsed report into a .kcache file (see load_cached_report)
+#   the file is written under a temporary name and renamed when complete
+def save_cached_report(cache_name, digest, columns):
+    names, taxids, level_nums, level_types, all_reads, level_reads = columns
+    tmp_name = "%s.%i.tmp" % (cache_name, os.getpid())
+    c_file = open(tmp_name, 'wb')
+    c_file.write(KCACHE_MAGIC)
+    c_file.write(digest)
+    c_file.write(struct.pack('<q', len(names)))
+    c_file.write(array('q', all_reads).tobytes())
+    c_file.write(array('q', level_reads).tobytes())
+    c_file.write(array('i', level_nums).tobytes())
+    c_file.write("\0".join(["\n".join(taxids), "\n".join(level_types), "\n".join(names)]).encode())
+    c_file.close()
+    os.replace(tmp_name, cache_name)
+
+####################################################################
+# prune_cache
+# usage: removes the least recently used .kcache files until the cache
+#   directory is not larger than max_size bytes
+def prune_cache(cache_dir, max_size):
+    entries = []
+    total_size = 0
+    for c_name in os.listdir(cache_dir):
+        if not c_name.endswith('.kcache'):
+            continue
+        stat = os.stat(os.path.join(cache_dir, c_name))
+        entries.append((stat.st_mtime, c_name, stat.st_size))
+        total_size += stat.st_size
+    entries.sort()
+    for mtime, c_name, size in entries:
+        if total_size <= max_size:
+            break
+        os.remove(os.path.join(cache_dir, c_name))
+        total_size -= size
+
+####################################################################
+# new_node
+# usage: creates a tree node with per-node read dictionaries (Tree)
+#   or, if a CountMatrix is given, a structure-only CompactNode
+#   tot_all is used to start from the reads of an existing combined report
+def new_node(name, taxid, level_num, level_id, parent=None, counts=None, tot_all=0):
+    if counts is None:
+        return Tree(name, taxid, level_num, level_id, tot_all, 0, None, parent)
+    return CompactNode(name, taxid, level_num, level_id, counts, parent, tot_all)
+
+####################################################################
+# rank_depth
+# usage: returns a sortable depth of a level ID in the taxonomy
+#   (position in main_lvls and number of the sub-level, e.g. S1 -> (9, 1))
+def rank_depth(level_id):
+    base = level_id.rstrip('0123456789')
+    sub = level_id[len(base):]
+    if base in main_lvls:
+        return (main_lvls.index(base), int(sub) if sub else 0)
+    return (-1, 0)
+
+####################################################################
+# valid_rank
+# usage: checks a level ID given to --ranks (a code of main_lvls, optionally
+#   followed by the number of a sub-level, e.g. S1)
+def valid_rank(level_id):
+    base = level_id.rstrip('0123456789')
+    return base in main_lvls and (base == level_id or base != 'U')
+
+####################################################################
+# expand_reads
+# usage: returns the reads of a row as integers
+#   (with --append-to the first element holds the formatted existing counts)
+def expand_reads(reads):
+    if len(reads) > 0 and isinstance(reads[0], str):
+        return [int(i) for i in reads[0].split('\t')] + reads[1:]
+    return reads
+
+####################################################################
+# derive_level_id
+# usage: determines the level ID of a newly added node, unranked levels ('-')
+#   and sub-levels are numbered below the level of their parent (e.g. S -> S1 -> S2)
+def derive_level_id(level_id, parent_level_id):
+    if level_id == '-' or len(level_id)> 1:
+        if parent_level_id in main_lvls:
+            level_id = parent_level_id + '1'
+        else:
+            num = int(parent_level_id[-1]) + 1
+            level_id = parent_level_id[:-1] + str(num)
+    return level_id
+
+####################################################################
+# read_combined_report
+# usage: loads an existing combined report (--append-to) as the starting tree
+#   the counts of the existing samples are only kept as formatted text per
+#   taxon (their sum is needed to sort the tree), so adding new samples does
+#   not depend on the number of existing samples
+# input:
+#   - combined report filename
+#   - taxid2node dictionary of the combined tree (filled in place)
+#   - CountMatrix for --compact (None for dictionary nodes)
+# returns:
+#   - list of sample header lines ('#name\tfilename') of the existing samples
+#   - list of existing sample names (report columns)
+#   - dictionary taxid -> formatted counts of the existing samples
+#     (taxid '0' for unclassified reads)
+def read_combined_report(c_filename, taxid2node, counts=None):
+    sample_lines = []
+    sample_names = None
+    old_reads = {}
+    lineage = []
+    c_lines = (line for data in report_chunks(c_filename) for line in data.split('\n'))
+    for line in c_lines:
+        line = line.rstrip('\r')
+        if line == '':
+            continue
+        if line.startswith('#'):
+            # Lines mapping sample ids to filenames
+            if '\t' in line:
+                sample_lines.append(line + '\n')
+            continue
+        if sample_names is None:
+            # Report columns
+            sample_names = line.split('\t')[:-3]
+            continue
+        [prefix, level_id, taxid, name] = line.rsplit('\t', 3)
+        old_reads[taxid] = prefix
+        if taxid == '0':
+            continue
+        spaces = len(name) - len(name.lstrip(' '))
+        name = name[spaces:]
+        level_num = int(spaces/2)
+        tot_all = sum(map(int, prefix.split('\t')))
+        if taxid == '1':
+            curr_node = new_node(name, taxid, level_num, level_id, None, counts, tot_all)
+            lineage = [curr_node]
+        else:
+            # Move to correct parent, the nearest shallower taxon of a higher level
+            # (reports written with --ranks skip levels but keep their indentation)
+            while lineage[-1].level_num >= level_num or (len(lineage) > 1
+                    and rank_depth(lineage[-1].level_id) >= rank_depth(level_id)):
+                lineage.pop()
+            curr_node = new_node(name, taxid, level_num, level_id, lineage[-1], counts, tot_all)
+            lineage[-1].add_child(curr_node)
+            lineage.append(curr_node)
+        taxid2node[taxid] = curr_node
+    # Siblings with equal reads are printed in reverse order of insertion,
+    # insert them in reverse order of the existing report to keep it
+    for taxid in taxid2node:
+        taxid2node[taxid].children.reverse()
+    return sample_lines, sample_names, old_reads
+
+####################################################################
+# add_report
+# usage: adds the parsed lines of one kraken report to the combined tree
+# input:
+#   - sample number (1-based, in order of the input reports)
+#   - parsed report lines (e.g. zip(*columns) of the columns of load_report)
+#   - taxid2node dictionary of the combined tree (updated in place)
+#   - u_reads dictionary of unclassified reads (updated in place)
+#   - CountMatrix for --compact (None for dictionary nodes)
+def add_report(count_samples, report, taxid2node, u_reads, counts=None):
+    with PausedGC():
+        add_report_lines(count_samples, report, taxid2node, u_reads, counts)
+
+####################################################################
+# add_report_lines
+# usage: adds the parsed lines to the combined tree (see add_report, without
+#   pausing the garbage collector)
+def add_report_lines(count_samples, report, taxid2node, u_reads, counts):
+    lineage = []
+    for report_vals in report:
+        [name, taxid, level_num, level_id, all_reads, level_reads] = report_vals
+        if level_id in map_lvls:
+            level_id = map_lvls[level_id]
+        # Unclassified 
+        if level_id == 'U' or taxid == '0':
+            u_reads[0] += all_reads
+            u_reads[count_samples] = all_reads 
+            continue
+        # Tree Root 
+        if taxid == '1': 
+            if taxid not in taxid2node:
+                taxid2node[taxid] = new_node(name, taxid, level_num, 'R', None, counts)
+            root_node = taxid2node[taxid]
+            root_node.add_reads(count_samples, all_reads, level_reads) 
+            lineage = [(level_num, root_node)]
+            continue 
+        # Move to correct parent, the last taxon of this report above this one
+        # (the combined tree may lack levels, e.g. with --append-to to a --ranks report)
+        while lineage[-1][0] >= level_num:
+            lineage.pop()
+        prev_node = lineage[-1][1]
+        # IF NODE EXISTS 
+        if taxid in taxid2node: 
+            taxid2node[taxid].add_reads(count_samples, all_reads, level_reads) 
+            lineage.append((level_num, taxid2node[taxid]))
+            continue 
+        # OTHERWISE
+        # Determine correct level ID
+        level_id = derive_level_id(level_id, prev_node.level_id)
+        # Add node to tree
+        curr_node = new_node(name, taxid, level_num, level_id, prev_node, counts)
+        curr_node.add_reads(count_samples, all_reads, level_reads)
+        taxid2node[taxid] = curr_node
+        prev_node.add_child(curr_node)
+        lineage.append((level_num, curr_node))
+
+####################################################################
+# report_header
+# usage: returns the column header line of a (combined) report
+def report_header(sample_names):
+    return "".join("%s\t" % i for i in sample_names) + "lvl_type\ttaxid\tname\n"
+
+####################################################################
+# raise_open_files_limit
+# usage: raises the soft limit of open files (up to the hard limit) so that
+#   all intermediate files of --streaming can be merged at once if possible
+# returns: the soft limit of open files (None if there is no limit)
+def raise_open_files_limit(num_files):
+    try:
+        import resource
+    except ImportError:
+        return None
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft != resource.RLIM_INFINITY and soft < num_files:
+        if hard != resource.RLIM_INFINITY:
+            num_files = min(num_files, hard)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (num_files, hard))
+        soft = num_files
+    if soft == resource.RLIM_INFINITY:
+        return None
+    return soft
+
+####################################################################
+# write_node
+# usage: writes one row to the overall report and to the writers of its level
+def write_node(o_file, lvl_writers, reads, level_id, taxid, level_num, name):
+    o_file.write_row(reads, level_id, taxid, level_num, name)
+    if level_id in lvl_writers:
+        for writer in lvl_writers[level_id]:
+            writer.write_row(reads, level_id, taxid, level_num, name)
+
+####################################################################
+# open_writer
+# usage: returns the writer of a combined report for the output format
+def open_writer(filename, sample_names, comments='', fmt='tsv'):
+    if fmt == 'parquet':
+        return ParquetReportWriter(filename, sample_names, comments)
+    if fmt in ['mtx', 'npz']:
+        return SparseReportWriter(filename, sample_names, comments, fmt)
+    return ReportWriter(filename, sample_names, comments, fmt)
+
+####################################################################
+# print_tree
+# usage: writes all nodes of the combined tree in a single traversal
+#   children are printed in decreasing order of total reads
+# input:
+#   - root node of the combined tree
+#   - number of samples
+#   - writer for the overall report
+#   - dictionary level_id -> list of writers that also receive rows of this level
+#   - formatted counts of existing samples per taxid and number of existing samples (--append-to)
+#   - TaxonFilter or None
+def print_tree(root_node, num_samples, o_file, lvl_writers, old_reads=None, num_old=0, taxon_filter=None):
+    if old_reads is not None:
+        old_zeros = "\t".join(["0"] * num_old)
+    all_nodes = [root_node]
+    while len(all_nodes) > 0:
+        # Remove node
+        curr_node = all_nodes.pop()
+        reads = curr_node.sample_reads(num_samples)
+        if old_reads is not None:
+            reads = [old_reads.get(curr_node.taxid, old_zeros)] + reads
+        # Taxa below this one can not have more reads
+        if taxon_filter is not None and not taxon_filter.keep_reads(reads):
+            continue
+        # Insert children
+        if len(curr_node.children) > 0 and (taxon_filter is None
+                or taxon_filter.descend(curr_node.level_id)):
+            curr_node.children.sort()
+            all_nodes.extend(curr_node.children)
+        # Print information for this node 
+        if taxon_filter is None or taxon_filter.write_level(curr_node.level_id):
+            write_node(o_file, lvl_writers, reads,
+                curr_node.level_id, curr_node.taxid, curr_node.level_num, curr_node.name)
+
+####################################################################
+# spool_report
+# usage: pre-pass of --streaming, writes the lines of one kraken report sorted
+#   by their taxid lineage (root -> taxon) into an intermediate file
+#   (runs in the worker processes with --threads)
+# input: tuple of kraken report filename, intermediate filename, cache directory and TaxonFilter
+# returns:
+#   - unclassified reads of this report (None if there is no U line)
+def spool_report(job):
+    r_file, spool_name, cache_dir, taxon_filter = job
+    u_count = None
+    rows = []
+    lineage = []
+    for report_vals in zip(*load_report(r_file, cache_dir, taxon_filter)):
+        [name, taxid, level_num, level_id, all_reads, level_reads] = report_vals
+        if level_id in map_lvls:
+            level_id = map_lvls[level_id]
+        # Unclassified 
+        if level_id == 'U' or taxid == '0':
+            u_count = all_reads
+            continue
+        # Tree Root 
+        if taxid == '1':
+            lineage = [(level_num, 1, 'R')]
+            rows.append(((1,), 'R', level_num, all_reads, name))
+            continue
+        # Move to correct parent
+        while level_num != (lineage[-1][0] + 1):
+            lineage.pop()
+        level_id = derive_level_id(level_id, lineage[-1][2])
+        lineage.append((level_num, int(taxid), level_id))
+        rows.append((tuple(node[1] for node in lineage), level_id, level_num, all_reads, name))
+    rows.sort(key=operator.itemgetter(0))
+    spool = open(spool_name, 'w', buffering=WRITE_BUFFER)
+    for key, level_id, level_num, all_reads, name in rows:
+        spool.write("%s\t%s\t%i\t%i\t%s\n" % (".".join(map(str, key)),
+            level_id, level_num, all_reads, name))
+    spool.close()
+    return u_count
+
+####################################################################
+# read_spool
+# usage: iterates over the sorted lines of one intermediate file of --streaming
+# returns (per line):
+#   - taxid lineage, sample index (0-based, the first sample of a file of several
+#     samples), level ID, level number, list of (sample index, all reads), name
+def read_spool(spool_name, sample):
+    spool = open(spool_name, 'r')
+    for line in spool:
+        path, level_id, level_num, all_reads, name = line.rstrip('\n').split('\t', 4)
+        if ':' in all_reads:
+            # Intermediate file of several samples (sample:reads,...)
+            reads = [tuple(map(int, i.split(':'))) for i in all_reads.split(',')]
+        else:
+            reads = [(sample, int(all_reads))]
+        yield (tuple(map(int, path.split('.'))), sample, level_id, int(level_num),
+            reads, name)
+    spool.close()
+
+####################################################################
+# merge_spool_rows
+# usage: k-way merge of sorted intermediate files of --streaming
+# input: streams of read_spool
+# returns (per taxon):
+#   - taxid lineage, (level ID, level number, name), list of (sample index, all reads)
+def merge_spool_rows(streams):
+    curr_key = None
+    for key, sample, level_id, level_num, reads, name in heapq.merge(*streams):
+        if key != curr_key:
+            if curr_key is not None:
+                yield curr_key, curr_vals, curr_reads
+            curr_key = key
+            curr_vals = (level_id, level_num, name)
+            curr_reads = []
+        curr_reads.extend(reads)
+    if curr_key is not None:
+        yield curr_key, curr_vals, curr_reads
+
+####################################################################
+# reduce_spools
+# usage: merges the intermediate files of --streaming in rounds of at most
+#   max_files files into intermediate files of several samples, until all
+#   remaining files can be opened at once (merged files are removed)
+# input: list of (sample index, intermediate filename), maximum number of open files
+# returns: list of (first sample index, intermediate filename)
+def reduce_spools(spools, max_files):
+    round_num = 0
+    while len(spools) > max_files:
+        merged = []
+        for start in range(0, len(spools), max_files):
+            group = spools[start:start + max_files]
+            if len(group) == 1:
+                merged.append(group[0])
+                continue
+            spool_name = "%s.%i-%i" % (group[0][1], round_num, start)
+            spool = open(spool_name, 'w', buffering=WRITE_BUFFER)
+            for key, vals, reads in merge_spool_rows([read_spool(name, i) for i, name in group]):
+                spool.write("%s\t%s\t%i\t%s\t%s\n" % (".".join(map(str, key)), vals[0], vals[1],
+                    ",".join("%i:%i" % i for i in reads), vals[2]))
+            spool.close()
+            for i, name in group:
+                os.remove(name)
+            merged.append((group[0][0], spool_name))
+        spools = merged
+        round_num += 1
+    return spools
+
+####################################################################
+# merge_spools
+# usage: k-way merge of the sorted intermediate files of --streaming, every
+#   combined row is written as soon as all inputs have moved past its taxon
+#   (only one line per input and one row of counts are kept in memory)
+#   with more files than max_files the files are first merged in rounds (reduce_spools)
+#   if no report has a root line an empty root row is written (as by print_tree)
+def merge_spools(spool_names, num_samples, o_file, lvl_writers, taxon_filter=None, max_files=None):
+    spools = list(enumerate(spool_names))
+    if max_files is not None:
+        spools = reduce_spools(spools, max_files)
+    streams = [read_spool(spool_name, i) for i, spool_name in spools]
+    has_root = False
+    for key, vals, sample_reads in merge_spool_rows(streams):
+        # The root sorts before all other taxa
+        if not has_root:
+            has_root = True
+            if key != (1,):
+                write_spooled_node(o_file, lvl_writers, [0] * num_samples,
+                    ('R', '1', 0, 'root'), taxon_filter)
+        reads = [0] * num_samples
+        for sample, all_reads in sample_reads:
+            reads[sample] = all_reads
+        write_spooled_node(o_file, lvl_writers, reads,
+            (vals[0], str(key[-1]), vals[1], vals[2]), taxon_filter)
+    if not has_root:
+        write_spooled_node(o_file, lvl_writers, [0] * num_samples,
+            ('R', '1', 0, 'root'), taxon_filter)
+
+####################################################################
+# write_spooled_node
+# usage: writes one merged row of --streaming if it passes the TaxonFilter
+#   (levels below the lowest requested rank were already dropped while parsing)
+def write_spooled_node(o_file, lvl_writers, reads, vals, taxon_filter):
+    if taxon_filter is not None:
+        if not taxon_filter.write_level(vals[0]) or not taxon_filter.keep_reads(reads):
+            return
+    write_node(o_file, lvl_writers, reads, *vals)
+
+####################################################################
+# sample_name
+# usage: returns the default sample name of an input file, the file name without
+#   its extension (and without the suffix of a compressed file, e.g. X.report.gz -> X)
+def sample_name(r_file):
+    name = os.path.basename(r_file)
+    for suffix in COMPRESSED_SUFFIXES:
+        if name.endswith(suffix):
+            name = name[:-len(suffix)]
+            break
+    return os.path.splitext(name)[0]
+
+####################################################################
+# split_values
+# usage: splits option values given separated by spaces and/or commas
+def split_values(values):
+    if not values:
+        return None
+    return [i for value in values for i in value.split(',') if i]
+
+####################################################################
+# add_output_args
+# usage: adds the options of the combined output and of the TaxonFilter to an
+#   ArgumentParser (shared by combine_kreports_modified.py and combine_koutputs.py)
+def add_output_args(parser):
+    parser.add_argument('--single-tax-level',required=False,dest='singletaxa',
+        action='store_true', default=False,
+        help='Set this to create single tables for each taxonomic level')
+    parser.add_argument('--compact',required=False,dest='compact',
+        action='store_true', default=False,
+        help='Set this to store read counts in a sparse taxa x samples matrix (lower memory for many samples)')
+    parser.add_argument('--tax-level-container',required=False,dest='container',
+        default=None,
+        help='Write the tables for each major taxonomic level into one container: X.npz or a directory X of Parquet files')
+    parser.add_argument('--ranks',required=False,dest='ranks',nargs='+',
+        default=None,
+        help='Only write taxa of these levels, e.g. U R P G S (separate by spaces or commas)')
+    parser.add_argument('--min-reads',required=False,dest='min_reads',
+        type=int, default=0,
+        help='Only write taxa with at least this number of reads (incl. lower levels) in --min-samples samples')
+    parser.add_argument('--min-samples',required=False,dest='min_samples',
+        type=int, default=1,
+        help='Number of samples that need at least --min-reads reads [default 1]')
+    parser.add_argument('--taxid-include',required=False,dest='taxid_include',nargs='+',
+        default=None,
+        help='Only keep these taxids, their lineage and all taxa below them (separate by spaces or commas)')
+    parser.add_argument('--taxid-exclude',required=False,dest='taxid_exclude',nargs='+',
+        default=None,
+        help='Remove these taxids and all taxa below them (separate by spaces or commas)')
+    parser.add_argument('--format',required=False,dest='format',
+        choices=OUTPUT_FORMATS, default='tsv',
+        help='Output format of the combined report(s) [default tsv]')
+
+####################################################################
+# make_taxon_filter
+# usage: checks the TaxonFilter options of add_output_args
+# returns: TaxonFilter (None if no taxa are filtered)
+def make_taxon_filter(args):
+    invalid_ranks = [rank for rank in split_values(args.ranks) or [] if not valid_rank(rank)]
+    if invalid_ranks:
+        sys.stderr.write("Unknown level(s) for --ranks: %s (use %s, sub-levels like S1)\n"
+            % (" ".join(invalid_ranks), " ".join(main_lvls)))
+        sys.exit(1)
+    if args.ranks or args.min_reads > 0 or args.taxid_include or args.taxid_exclude:
+        return TaxonFilter(split_values(args.ranks), args.min_reads, args.min_samples,
+            split_values(args.taxid_include), split_values(args.taxid_exclude))
+    return None
+
+####################################################################
+# write_combined
+# usage: writes the combined report and the per-level outputs of add_output_args
+#   (steps 2 and 3 of combine_kreports_modified.py and combine_koutputs.py)
+# input:
+#   - args with the options of add_output_args and the output filename
+#   - names of all samples (existing samples of --append-to first)
+#   - header lines of the combined report
+#   - u_reads dictionary of unclassified reads of the new samples
+#   - root node of the combined tree (None with spool_names)
+#   - number of new samples
+#   - TaxonFilter (None if no taxa are filtered)
+#   - bracken: no unclassified row
+#   - old_reads and number of the samples of --append-to
+#   - intermediate files of --streaming, merged instead of printing the tree
+def write_combined(args, sample_names, header, u_reads, root_node, num_samples, taxon_filter=None,
+        bracken=False, old_reads=None, num_old=0, spool_names=None):
+    #################################################
+    # STEP 2: SETUP OUTPUT FILE
+    sys.stdout.write(">>STEP 2: WRITING NEW REPORT HEADERS\n")
+    o_file = open_writer(args.output, sample_names, header, args.format)
+    # Separate reports for every taxonomic level, filled in the same pass
+    lvl_writers = {}
+    if args.singletaxa:
+        for osplit in main_lvls:
+            if osplit not in ["U","R"]:
+                lvl_writers[osplit] = [open_writer(args.output + "-" + osplit,
+                    sample_names, '', args.format)]
+    if args.container:
+        tables = LevelTables(args.container, sample_names,
+            [osplit for osplit in main_lvls if osplit not in ["U","R"]])
+        for osplit in tables.rows:
+            lvl_writers.setdefault(osplit, []).append(tables)
+    #################################################
+    # STEP 3: PRINT TREE
+    if bracken:
+        print(">>NOTE: bracken input (--bracken) - ignore unclassified")
+    sys.stdout.write(">>STEP 3: PRINTING OVERALL REPORT")
+    if args.singletaxa:
+        sys.stdout.write(" AND SEPARATE REPORTS PER TAXONOMIC LEVEL")
+    sys.stdout.write("\n")
+    all_writers = [o_file]
+    for osplit in lvl_writers:
+        for writer in lvl_writers[osplit]:
+            if writer not in all_writers:
+                all_writers.append(writer)
+    # Print line for unclassified reads
+    if not bracken and (taxon_filter is None or taxon_filter.write_level('U')):
+        reads = [u_reads.get(i+1, 0) for i in range(num_samples)]
+        if old_reads is not None:
+            reads = [old_reads.get('0', "\t".join(["0"] * num_old))] + reads
+        for writer in all_writers:
+            writer.write_row(reads, 'U', '0', 0, 'unclassified')
+    # Print for all remaining reads 
+    if spool_names is not None:
+        limit = raise_open_files_limit(num_samples + SPOOL_MARGIN)
+        max_files = max(2, limit - SPOOL_MARGIN) if limit is not None else None
+        merge_spools(spool_names, num_samples, o_file, lvl_writers, taxon_filter, max_files)
+    else:
+        print_tree(root_node, num_samples, o_file, lvl_writers, old_reads, num_old,
+            taxon_filter)
+    for writer in all_writers:
+        writer.close()
+
 ####################################################################
 # Main method
 def main():
@@ -136,15 +1424,40 @@ def main():
     parser.add_argument('--bracken',required=False,dest='bracken',
         action='store_true', default=False,
         help='Set this for bracken input - omits representation of unclassified fraction')
-    parser.add_argument('--single-tax-level',required=False,dest='singletaxa',
+    parser.add_argument('-t','--threads','--processes',required=False,dest='processes',
+        type=int, default=1,
+        help='Number of worker processes used to parse the reports [default 1]')
+    parser.add_argument('--streaming',required=False,dest='streaming',
         action='store_true', default=False,
-        help='Set this to create single tables for each taxonomic level')
+        help='Set this for a low-memory k-way merge of the reports (taxa are written in taxonomic order)')
+    parser.add_argument('--tmp-dir',required=False,dest='tmp_dir',
+        default=None,
+        help='Directory for the intermediate files of --streaming [default: system temp directory]')
+    parser.add_argument('--append-to',required=False,dest='append_to',
+        default=None,
+        help='Existing combined report to which the input reports are added as new samples')
+    parser.add_argument('--cache-dir',required=False,dest='cache_dir',
+        default=None,
+        help='Directory for binary caches of the parsed reports, unchanged reports are not parsed again')
+    parser.add_argument('--cache-size',required=False,dest='cache_size',
+        type=int, default=1024,
+        help='Maximum size of the cache directory in MB, least recently used entries are removed [default 1024]')
+    add_output_args(parser)
     args=parser.parse_args()
-    
+    # The intermediate files of --streaming are removed even if merging fails
+    spool_dirs = []
+    try:
+        combine_reports(args, spool_dirs)
+    finally:
+        for spool_dir in spool_dirs:
+            shutil.rmtree(spool_dir, ignore_errors=True)
 
+####################################################################
+# combine_reports
+# usage: reads the input reports and writes the combined report(s) (see main)
+#   the directory of the intermediate files of --streaming is added to spool_dirs
+def combine_reports(args, spool_dirs):
     # Initialize combined values 
-    main_lvls = ['U','R','D','K','P','C','O','F','G','S']
-    map_lvls = {'kingdom':'K', 'superkingdom':'D','phylum':'P','class':'C','order':'O','family':'F','genus':'G','species':'S'}
     count_samples = 0
     num_samples = len(args.r_files)
     if args.s_names:
@@ -152,19 +1465,27 @@ def main():
     else:
         sample_names = []
         for r_file in args.r_files:
-            name = os.path.basename(r_file)
-            name = os.path.splitext(name)[0]
-            sample_names.append(name)
-    root_node = -1 
-    prev_node = -1
-    curr_node = -1
+            sample_names.append(sample_name(r_file))
     u_reads = {0:0} 
     taxid2node = {}
+    counts = CountMatrix(num_samples) if args.compact else None
 
     # Check input values 
     if len(sample_names) > 0 and len(sample_names) != num_samples: 
         sys.stderr.write("Number of sample names provided does not match number of reports\n")
         sys.exit(1)
+    if args.append_to and args.streaming:
+        sys.stderr.write("--append-to can not be combined with --streaming\n")
+        sys.exit(1)
+    # Taxa to read and write
+    taxon_filter = make_taxon_filter(args)
+    # Existing combined report
+    old_lines = []
+    old_names = []
+    old_reads = None
+    if args.append_to:
+        sys.stdout.write(">>STEP 0: READING EXISTING REPORT %s\n" % args.append_to)
+        old_lines, old_names, old_reads = read_combined_report(args.append_to, taxid2node, counts)
     # Map names
     id2names = {} 
     id2files = {} 
@@ -183,162 +1504,63 @@ def main():
     sys.stdout.write(">>STEP 1: READING REPORTS\n")
     sys.stdout.write("\t%i/%i samples processed" % (count_samples, num_samples))
     sys.stdout.flush()
-    for r_file in args.r_files:
+    # Reports are parsed independently (in worker processes with --threads)
+    # and added to the tree in input order, so the result does not depend
+    # on the number of processes
+    # With --streaming every report is only sorted into an intermediate file
+    spool_names = None
+    if args.streaming:
+        spool_dir = tempfile.mkdtemp(prefix='combine_kreports_', dir=args.tmp_dir)
+        spool_dirs.append(spool_dir)
+        spool_names = [os.path.join(spool_dir, "%i.spool" % (i+1)) for i in range(num_samples)]
+        worker = spool_report
+        jobs = [(r_file, spool_name, args.cache_dir, taxon_filter)
+            for r_file, spool_name in zip(args.r_files, spool_names)]
+    else:
+        worker = partial(load_report, cache_dir=args.cache_dir, taxon_filter=taxon_filter)
+        jobs = args.r_files
+    if args.cache_dir is not None:
+        os.makedirs(args.cache_dir, exist_ok=True)
+    if args.processes > 1:
+        pool = Pool(args.processes)
+        chunksize = max(1, num_samples // (args.processes * 4))
+        results = pool.imap(worker, jobs, chunksize)
+    else:
+        pool = None
+        results = map(worker, jobs)
+    for r_file, result in zip(args.r_files, results):
         count_samples += 1 
         sys.stdout.write("\r\t%i/%i samples processed" % (count_samples, num_samples))
         sys.stdout.flush()
         id2files[count_samples] = r_file
-        # Open File 
-        curr_file = open(r_file,'r')
-        for line in curr_file: 
-            report_vals = process_kraken_report(line)
-            if len(report_vals) < 5:
-                continue
-            [name, taxid, level_num, level_id, all_reads, level_reads] = report_vals
-            if level_id in map_lvls:
-                level_id = map_lvls[level_id]
-            # Unclassified 
-            if level_id == 'U' or taxid == '0':
-                u_reads[0] += all_reads
-                u_reads[count_samples] = all_reads 
-                continue
-            # Tree Root 
-            if taxid == '1': 
-                if count_samples == 1:
-                    root_node = Tree(name, taxid, level_num, 'R', 0,0)
-                    taxid2node[taxid] = root_node 
-                root_node.add_reads(count_samples, all_reads, level_reads) 
-                prev_node = root_node
-                continue 
-            # Move to correct parent
-            while level_num != (prev_node.level_num + 1):
-                prev_node = prev_node.parent
-            # IF NODE EXISTS 
-            if taxid in taxid2node: 
-                taxid2node[taxid].add_reads(count_samples, all_reads, level_reads) 
-                prev_node = taxid2node[taxid]
-                continue 
-            # OTHERWISE
-            # Determine correct level ID
-            if level_id == '-' or len(level_id)> 1:
-                if prev_node.level_id in main_lvls:
-                    level_id = prev_node.level_id + '1'
-                else:
-                    num = int(prev_node.level_id[-1]) + 1
-                    level_id = prev_node.level_id[:-1] + str(num)
-            # Add node to tree
-            curr_node = Tree(name, taxid, level_num, level_id, 0, 0, None, prev_node)
-            curr_node.add_reads(count_samples, all_reads, level_reads)
-            taxid2node[taxid] = curr_node
-            prev_node.add_child(curr_node)
-            prev_node = curr_node 
-        curr_file.close()
+        if args.streaming:
+            if result is not None:
+                u_reads[0] += result
+                u_reads[count_samples] = result
+        else:
+            add_report(count_samples, zip(*result), taxid2node, u_reads, counts)
+    if pool is not None:
+        pool.close()
+        pool.join()
+    # Reports without classified reads have no root
+    if not args.streaming and '1' not in taxid2node:
+        taxid2node['1'] = new_node('root', '1', 0, 'R', None, counts)
+    if counts is not None:
+        counts.finalize()
+    if args.cache_dir is not None:
+        prune_cache(args.cache_dir, args.cache_size * 1024 * 1024)
 
     sys.stdout.write("\r\t%i/%i samples processed\n" % (count_samples, num_samples))
     sys.stdout.flush()
 
-    #################################################
-    # STEP 2: SETUP OUTPUT FILE
-    sys.stdout.write(">>STEP 2: WRITING NEW REPORT HEADERS\n")
-    o_file = open(args.output,'w') 
     # Lines mapping sample ids to filenames
-    o_file.write("#Number of Samples: %i\n" % num_samples) 
+    header = "#Number of Samples: %i\n" % (len(old_names) + num_samples)
+    header += "".join(old_lines)
     for i in id2names:
-        o_file.write("#")
-        o_file.write("%s\t" % id2names[i])
-        o_file.write("%s\n" % id2files[i])
-        #Report columns
-    for i in sample_names:
-        o_file.write("%s\t" % i)
-    o_file.write("lvl_type\ttaxid\tname\n")
-    #################################################
-    # STEP 3a: PRINT TREE
-    if args.bracken:
-        print(">>NOTE: bracken input (--bracken) - ignore unclassified")
-    sys.stdout.write(">>STEP 3a: PRINTING OVERALL REPORT\n")
-    # Print line for unclassified reads
-    if args.bracken:
-        pass
-    else:
-        for i in u_reads:
-            if (i > 0): #i == 0 or 
-                o_file.write("%i\t" % u_reads[i])
-        o_file.write("U\t0\tunclassified\n")
-    # Print for all remaining reads 
-    all_nodes = [root_node]
-    curr_node = -1
-    prev_node = -1
-    while len(all_nodes) > 0:
-        # Remove node and insert children
-        curr_node = all_nodes.pop()
-        if len(curr_node.children) > 0:
-            curr_node.children.sort()
-            for node in curr_node.children:
-                all_nodes.append(node)
-        # Print information for this node 
-        for i in range(num_samples):
-            if (i+1) not in curr_node.all_reads: 
-                o_file.write("0\t")
-            else:
-                o_file.write("%i\t" % curr_node.all_reads[i+1])
-        o_file.write("%s\t" % curr_node.level_id)
-        o_file.write("%s\t" % curr_node.taxid)
-        o_file.write(" "*curr_node.level_num*2)
-        o_file.write("%s\n" % curr_node.name)
-
-    o_file.close() 
+        header += "#%s\t%s\n" % (id2names[i], id2files[i])
+    write_combined(args, old_names + sample_names, header, u_reads, taxid2node.get('1'), num_samples,
+        taxon_filter, args.bracken, old_reads, len(old_names), spool_names)
 
-#########################################################################################
-    # STEP 3b: PRINT SEPARATE REPORTS FOR EVERY TAXONOMIC LEVEL
-    if args.singletaxa:
-        for osplit in main_lvls:
-            if osplit in ["U","R"]:
-                pass
-            else:
-                osplit_name = args.output + "-" + osplit
-                osplit_file = open(osplit_name,'w') 
-                # Lines mapping sample ids to filenames
-
-                for i in sample_names:
-                    osplit_file.write("%s\t" % i)
-                osplit_file.write("lvl_type\ttaxid\tname\n")
-
-                #################################################
-                # STEP 3: PRINT TREE
-                sys.stdout.write(">>STEP 3b: PRINTING SEPARATE REPORTS PER TAXONMIC LEVEL \n")
-                # Print line for unclassified reads
-                if args.bracken:
-                    pass
-                else:
-                    for i in u_reads:
-                        if (i > 0): #i == 0 or 
-                            osplit_file.write("%i\t" % u_reads[i])
-                    osplit_file.write("U\t0\tunclassified\n")
-                # Print for all remaining reads 
-                all_nodes = [root_node]
-                curr_node = -1
-                prev_node = -1
-                while len(all_nodes) > 0:
-                    # Remove node and insert children
-                    curr_node = all_nodes.pop()
-                    if len(curr_node.children) > 0:
-                        curr_node.children.sort()
-                        for node in curr_node.children:
-                            all_nodes.append(node)
-                    # Print information for this node 
-                        if curr_node.level_id == osplit:
-                            for i in range(num_samples):
-                                if (i+1) not in curr_node.all_reads: 
-                                    osplit_file.write("0\t")
-                                else:
-                                    osplit_file.write("%i\t" % curr_node.all_reads[i+1])
-                            osplit_file.write("%s\t" % curr_node.level_id)
-                            osplit_file.write("%s\t" % curr_node.taxid)
-                            osplit_file.write(" "*curr_node.level_num*2)
-                            osplit_file.write("%s\n" % curr_node.name)
-
-                osplit_file.close() 
-        
 ####################################################################
 if __name__ == "__main__":
     main()
@@ -1,10 +1,40 @@
 #!/usr/bin/python3
 
 import pandas as pd
-import seaborn as sns
 import os
 import sys
 import argparse
+from multiprocessing import Pool
+
+from emapper_utils import EntryCounter, CountMatrix, read_annotations
+
+# count the KOs and COG categories of one emapper annotation file
+#   job: (file name, chunksize), with chunksize the file is read in tables of at most
+#   chunksize rows and the counts are accumulated, so memory stays bounded
+# (runs in the worker processes with --jobs)
+def count_sample(job):
+    emapfile, chunksize = job
+    ko_counter = EntryCounter(',')
+    cog_counter = EntryCounter('')
+
+    # open emapper.annotations file with only the query_name, KEGG_ko and COG Functional cat. columns
+    tables = read_annotations(emapfile, ['#query_name','KEGG_ko','COG Functional cat.'], chunksize)
+    if chunksize is None:
+        tables = [tables]
+    for sample in tables:
+        # drop all lines where KEGG_ko is NaN
+        select = sample['KEGG_ko']
+        select = select[select.notna()].replace(to_replace ='ko:', value = '', regex = True)
+        # split KEGG_ko column by ',' and count every KO
+        ko_counter.update(select)
+
+        # drop all lines where COG Functional cat. is NaN
+        select = sample['COG Functional cat.']
+        select = select[select.notna()]
+        # split COG Functional cat. column after every letter and count every COG
+        cog_counter.update(select)
+
+    return ko_counter.result(), cog_counter.result()
 
 def main(argv):
  
@@ -12,6 +42,10 @@ def main(argv):
     parser = argparse.ArgumentParser(description='Process some integers.')
     parser.add_argument('-i', '--inputdir', default='.', help='set the input directory containing emapper output *.annotations')
     parser.add_argument('-s', '--single', action='store_true', help='produce additional output tsv for KO and COG counts of each single dataset')
+    parser.add_argument('--sparse-out', choices=['npz','mtx'], help='additionally save the merged counts as sparse matrix (npz: scipy CSR arrays, mtx: Matrix Market with .rows.tsv and .samples.tsv)')
+    parser.add_argument('--streaming', action='store_true', help='read the annotation files in chunks of --chunksize rows, memory stays bounded for huge files')
+    parser.add_argument('--chunksize', type=int, default=200000, help='number of rows per chunk with --streaming [default 200000]')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='number of worker processes counting the datasets in parallel [default 1]')
 
     args = parser.parse_args()
 
@@ -19,98 +53,67 @@ def main(argv):
     workingdir = os.chdir(args.inputdir)
     # list all files in wd and save as entries
     entries = os.listdir(workingdir)
+    emapfiles = [emapfile for emapfile in entries if emapfile.endswith('.annotations')]
+    chunksize = args.chunksize if args.streaming is True else None
+    jobs = [(emapfile, chunksize) for emapfile in emapfiles]
 
     #######
 
-    # create combi dataframe with column name used for merging in loop
-    combi = pd.DataFrame(columns = ['KEGG_ko'])
+    # per-sample counts, merged into one feature x sample matrix after all datasets are counted
+    samplenames = []
+    ko_samples = []
+    cog_samples = []
+
+    # datasets are counted independently (in worker processes with --jobs),
+    # the counts are merged here in the order of the files
+    if args.jobs > 1:
+        pool = Pool(args.jobs)
+        results = pool.imap(count_sample, jobs)
+    else:
+        pool = None
+        results = map(count_sample, jobs)
 
     # loop over all files in wd that end with annotations
-    for emapfile in entries:
-        if emapfile.endswith('.annotations'):
-            print('processing dataset ==> ',emapfile)
-            # open emapper.annotations file (skip first 3 rows)
-            sample = pd.read_csv(emapfile, sep='\t', skiprows=3)
-            # select only query_name and KEGG_ko column
-            select = sample.loc[:,['#query_name','KEGG_ko']]
-            # drop all lines where KEGG_ko is NaN
-            select = select[select['KEGG_ko'].notna()]
-            select = select.replace(to_replace ='ko:', value = '', regex = True) 
-
-            # iterate over each row to split KEGG_ko column by ',' and concatenate into new file 
-            splitted = pd.concat([pd.Series(row['#query_name'], row['KEGG_ko'].split(','))              
-                for _, row in select.iterrows()]).reset_index()
-            # rename columns
-            splitted.columns = ['KEGG_ko', 'query_name']
-            
-            # calculate counts for every KO 
-            ko_counts = pd.DataFrame(splitted['KEGG_ko'].value_counts()).rename_axis('KEGG_ko', axis=0)
-            ko_counts.columns = [str(emapfile).replace('.emapper.annotations','')]
-
-            # loop over merging the KO counts of all input files into the dataframe combi
-            combi = pd.merge(combi, ko_counts, how='outer', on='KEGG_ko')
-            
-            # if set save KOs and counts to separate files
-            if args.single is True:
-                print('saving KO counts for single dataset: ', str(emapfile).replace('.emapper.annotations',''))
-                ko_counts.to_csv(emapfile + '.KEGG-ko-counts.csv')
-
-        else:
-            continue
-
-    # rename column to comply with microbiomeanalyst input
-    combi.rename(columns={'KEGG_ko': '#NAME'}, inplace=True)
-    # replace missing values with 0
-    combi = combi.fillna(0)
+    for emapfile, (ko_series, cog_series) in zip(emapfiles, results):
+        print('processing dataset ==> ',emapfile)
+        samplename = str(emapfile).replace('.emapper.annotations','')
+
+        samplenames.append(samplename)
+        ko_samples.append(ko_series)
+        cog_samples.append(cog_series)
+
+        # if set save KOs, COGs and counts to separate files
+        if args.single is True:
+            print('saving KO counts for single dataset: ', samplename)
+            ko_counts = pd.DataFrame(ko_series).rename_axis('KEGG_ko', axis=0)
+            ko_counts.columns = [samplename]
+            ko_counts.to_csv(emapfile + '.KEGG-ko-counts.csv')
+            print('saving COG counts for single dataset: ', samplename)
+            cog_counts = pd.DataFrame(cog_series).rename_axis('COG', axis=0)
+            cog_counts.columns = [samplename]
+            cog_counts.to_csv(emapfile + '.COG-counts.csv')
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+    # build the KO x sample matrix, first column named to comply with microbiomeanalyst input
+    combi = CountMatrix(samplenames, ko_samples)
     # save KO counts
     print('\nsaving merged KO counts to KEGG_ko_counts.csv\n')
-    combi.to_csv('KEGG_ko_counts.csv', index=False)
+    combi.to_frame('#NAME').to_csv('KEGG_ko_counts.csv', index=False)
+    if args.sparse_out is not None:
+        combi.save('KEGG_ko_counts.' + args.sparse_out)
 
     ########
 
-    # create combi dataframe with column name used for merging in loop
-    combicog = pd.DataFrame(columns = ['COG'])
-
-     # loop over all files in wd that end with annotations
-    for emapfile in entries:
-        if emapfile.endswith('.annotations'):
-            print('processing dataset ==> ',emapfile)
-            # open emapper.annotations file (skip first 3 rows)
-            sample = pd.read_csv(emapfile, sep='\t', skiprows=3)
-            #print(sample.head())
-            # select only query_name and COG Functional cat. column
-            select = sample.loc[:,['#query_name','COG Functional cat.']]
-            # drop all lines where COG Functional cat. is NaN
-            select = select[select['COG Functional cat.'].notna()]
-
-            # iterate over each row to split COG Functional cat. column by '' and concatenate into new file 
-            splitted = pd.concat([pd.Series(row['#query_name'], list(row['COG Functional cat.']))              
-                for _, row in select.iterrows()]).reset_index()
-            # rename columns
-            splitted.columns = ['COG Functional cat.', 'query_name']
-            
-            # calculate counts for every COG 
-            cog_counts = pd.DataFrame(splitted['COG Functional cat.'].value_counts()).rename_axis('COG', axis=0)
-            cog_counts.columns = [str(emapfile).replace('.emapper.annotations','')]
-
-            # loop over merging the KO counts of all input files into the dataframe combi
-            combicog = pd.merge(combicog, cog_counts, how='outer', on='COG')
-            
-            # if set save COGs and counts to separate files
-            if args.single is True:
-                print('saving COG counts for single dataset: ', str(emapfile).replace('.emapper.annotations',''))
-                cog_counts.to_csv(emapfile + '.COG-counts.csv')
-
-        else:
-            continue
-
-    # rename column to comply with microbiomeanalyst input
-    combicog.rename(columns={'COG': '#NAME'}, inplace=True)
-    # replace missing values with 0
-    combicog = combicog.fillna(0)
+    # build the COG x sample matrix, first column named to comply with microbiomeanalyst input
+    combicog = CountMatrix(samplenames, cog_samples)
     # save COG counts
     print('\nsaving merged COG counts to COG_counts.csv\n')
-    combicog.to_csv('COG_counts.csv', index=False)
+    combicog.to_frame('#NAME').to_csv('COG_counts.csv', index=False)
+    if args.sparse_out is not None:
+        combicog.save('COG_counts.' + args.sparse_out)
 
 
     # bye bye
@@ -5,15 +5,84 @@ import os
 import sys
 import argparse
 
+from emapper_utils import EntryCounter, CountMatrix, read_annotations, read_mapping, rollup
+from emapper_utils import cache_name, file_digest, load_cached_counts, save_cached_counts, prune_cache
+
+# categories that can be counted from the emapper annotations
+#   column: column in the emapper output
+#   name: name of the category column in the count tables
+#   replace: regex removed from the column before splitting
+#   split: separator of multiple entries per gene ('' splits after every letter)
+#   label: used in messages
+#   single: suffix of the count tables of single datasets
+#   combined: file name of the merged count table
+CATEGORIES = {
+    'ko': {'column': 'KEGG_ko', 'name': 'KEGG_ko', 'replace': 'ko:', 'split': ',',
+        'label': 'KO', 'single': '.KEGG-ko-counts.csv', 'combined': 'KEGG_ko_counts.csv'},
+    'cog': {'column': 'COG Functional cat.', 'name': 'COG', 'replace': None, 'split': '',
+        'label': 'COG', 'single': '.COG-counts.csv', 'combined': 'COG_counts.csv'},
+    'pathway': {'column': 'KEGG_Pathway', 'name': 'KEGG_Pathway', 'replace': ',map.*', 'split': ',',
+        'label': 'KEGG Pathway', 'single': '.KEGG-Pathway-counts.csv', 'combined': 'KEGG_Pathway_counts.csv'},
+    'module': {'column': 'KEGG_Module', 'name': 'KEGG_Module', 'replace': None, 'split': ',',
+        'label': 'KEGG Module', 'single': '.KEGG-Module-counts.csv', 'combined': 'KEGG_Module_counts.csv'},
+    'cazy': {'column': 'CAZy', 'name': 'CAZy', 'replace': None, 'split': ',',
+        'label': 'CAZy', 'single': '.CAZy-counts.csv', 'combined': 'CAZy_counts.csv'},
+    'ec': {'column': 'EC', 'name': 'EC', 'replace': None, 'split': ',',
+        'label': 'EC', 'single': '.EC-counts.csv', 'combined': 'EC_counts.csv'},
+}
+
+# entries of one category in an emapper annotation table
+def category_values(sample, category):
+    column = category['column']
+    # select only the category column
+    select = sample[column]
+    # drop all lines where the category is NaN
+    select = select[select.notna()]
+    if category['replace'] is not None:
+        select = select.replace(to_replace = category['replace'], value = '', regex = True)
+    return select
+
 def main(argv):
- 
+
  # define user input
     parser = argparse.ArgumentParser(description='Process some integers.')
     parser.add_argument('-i', '--inputdir', default='.', help='set the input directory containing emapper output *.annotations')
     parser.add_argument('-s', '--single', action='store_true', help='produce additional output tsv for KO and COG counts of each single dataset')
+    parser.add_argument('--sparse-out', choices=['npz','mtx'], help='additionally save the merged counts as sparse matrix, including the tables rolled up with --pathway-map/--module-map (npz: scipy CSR arrays, mtx: Matrix Market with .rows.tsv and .samples.tsv, real values with --split-weight)')
+    parser.add_argument('--streaming', action='store_true', help='read the annotation files in chunks of --chunksize rows, memory stays bounded for huge files')
+    parser.add_argument('--chunksize', type=int, default=200000, help='number of rows per chunk with --streaming [default 200000]')
+    parser.add_argument('--cache-dir', help='directory caching the counts of every dataset, unchanged datasets (same path, time, size and content) are not parsed again')
+    parser.add_argument('--cache-size', type=int, default=1024, help='maximum size of --cache-dir in MB, least recently used counts are removed first [default 1024]')
+    parser.add_argument('--pathway-map', help='tab-separated KO -> pathway mapping file (e.g. KEGG link/pathway/ko). KEGG_Pathway counts are then rolled up from the KO counts instead of parsing the KEGG_Pathway column (no single dataset tables)')
+    parser.add_argument('--module-map', help='tab-separated KO -> module mapping file (e.g. KEGG link/module/ko). KEGG_Module counts are then rolled up from the KO counts instead of parsing the KEGG_Module column (no single dataset tables)')
+    parser.add_argument('--split-weight', action='store_true', help='with --pathway-map/--module-map divide the count of a KO evenly among its pathways or modules instead of adding it to each')
+    parser.add_argument('--categories', default='ko,cog,pathway,cazy', help='comma-separated categories to count, all are counted while reading each file once (repeated categories only once). Valid categories are ' + ','.join(CATEGORIES) + ' [default ko,cog,pathway,cazy]')
 
     args = parser.parse_args()
 
+    # repeated categories are counted once, in the order given
+    categories = list(dict.fromkeys(args.categories.split(',')))
+    for cat in categories:
+        if cat not in CATEGORIES:
+            print("Category", cat, "not valid - please choose from", ','.join(CATEGORIES))
+            print(" == EXITING == ")
+            exit()
+
+    # pathways and modules rolled up from the KO counts, the KOs are counted for them
+    mapfiles = {'pathway': args.pathway_map, 'module': args.module_map}
+    rollups = [cat for cat in categories if mapfiles.get(cat) is not None]
+    mappings = {}
+    for cat in rollups:
+        mappings[cat] = read_mapping(mapfiles[cat])
+    counted = [cat for cat in categories if cat not in rollups]
+    if len(rollups) > 0 and 'ko' not in counted:
+        counted.append('ko')
+
+    # the cache directory is given relative to the directory the script is called from
+    if args.cache_dir is not None:
+        args.cache_dir = os.path.abspath(args.cache_dir)
+        os.makedirs(args.cache_dir, exist_ok=True)
+
     # set wd
     workingdir = os.chdir(args.inputdir)
     # list all files in wd and save as entries
@@ -21,187 +90,100 @@ def main(argv):
 
     #######
 
-    # create combi dataframe with column name used for merging in loop
-    combi = pd.DataFrame(columns = ['KEGG_ko'])
-
-    # loop over all files in wd that end with annotations
-    for emapfile in entries:
-        if emapfile.endswith('.annotations'):
-            print('processing dataset ==> ',emapfile)
-            # open emapper.annotations file (skip first 3 rows)
-            sample = pd.read_csv(emapfile, sep='\t', skiprows=3)
-            # select only query_name and KEGG_ko column
-            select = sample.loc[:,['#query_name','KEGG_ko']]
-            # drop all lines where KEGG_ko is NaN
-            select = select[select['KEGG_ko'].notna()]
-            select = select.replace(to_replace ='ko:', value = '', regex = True) 
-
-            # iterate over each row to split KEGG_ko column by ',' and concatenate into new file 
-            splitted = pd.concat([pd.Series(row['#query_name'], row['KEGG_ko'].split(','))              
-                for _, row in select.iterrows()]).reset_index()
-            # rename columns
-            splitted.columns = ['KEGG_ko', 'query_name']
-            
-            # calculate counts for every KO 
-            ko_counts = pd.DataFrame(splitted['KEGG_ko'].value_counts()).rename_axis('KEGG_ko', axis=0)
-            ko_counts.columns = [str(emapfile).replace('.emapper.annotations','')]
-
-            # loop over merging the KO counts of all input files into the dataframe combi
-            combi = pd.merge(combi, ko_counts, how='outer', on='KEGG_ko')
-            
-            # if set save KOs and counts to separate files
-            if args.single is True:
-                print('saving KO counts for single dataset: ', str(emapfile).replace('.emapper.annotations',''))
-                ko_counts.to_csv(emapfile + '.KEGG-ko-counts.csv')
-
-        else:
-            continue
-
-    # rename column to comply with microbiomeanalyst input
-    combi.rename(columns={'KEGG_ko': '#NAME'}, inplace=True)
-    # replace missing values with 0
-    combi = combi.fillna(0)
-    # save KO counts
-    print('\nsaving merged KO counts to KEGG_ko_counts.csv\n')
-    combi.to_csv('KEGG_ko_counts.csv', index=False)
-
-    ########
-
-    # create combi dataframe with column name used for merging in loop
-    combicog = pd.DataFrame(columns = ['COG'])
-
-    # loop over all files in wd that end with annotations
-    for emapfile in entries:
-        if emapfile.endswith('.annotations'):
-            print('processing dataset ==> ',emapfile)
-            # open emapper.annotations file (skip first 3 rows)
-            sample = pd.read_csv(emapfile, sep='\t', skiprows=3)
-            #print(sample.head())
-            # select only query_name and COG Functional cat. column
-            select = sample.loc[:,['#query_name','COG Functional cat.']]
-            # drop all lines where COG Functional cat. is NaN
-            select = select[select['COG Functional cat.'].notna()]
-
-            # iterate over each row to split COG Functional cat. column by '' and concatenate into new file 
-            splitted = pd.concat([pd.Series(row['#query_name'], list(row['COG Functional cat.']))              
-                for _, row in select.iterrows()]).reset_index()
-            # rename columns
-            splitted.columns = ['COG Functional cat.', 'query_name']
-            
-            # calculate counts for every COG 
-            cog_counts = pd.DataFrame(splitted['COG Functional cat.'].value_counts()).rename_axis('COG', axis=0)
-            cog_counts.columns = [str(emapfile).replace('.emapper.annotations','')]
-
-            # loop over merging the KO counts of all input files into the dataframe combi
-            combicog = pd.merge(combicog, cog_counts, how='outer', on='COG')
-      
-            # if set save COGs and counts to separate files
-            if args.single is True:
-                print('saving COG counts for single dataset: ', str(emapfile).replace('.emapper.annotations',''))
-                cog_counts.to_csv(emapfile + '.COG-counts.csv')
-
-        else:
-            continue
+    # per-sample counts of every category, merged into one feature x sample matrix after all datasets are counted
+    samplenames = []
+    sample_counts = {}
+    for cat in counted:
+        sample_counts[cat] = []
 
-    # rename column to comply with microbiomeanalyst input
-    combicog.rename(columns={'COG': '#NAME'}, inplace=True)
-    # replace missing values with 0
-    combicog = combicog.fillna(0)
-    # save COG counts
-    print('\nsaving merged COG counts to COG_counts.csv\n')
-    combicog.to_csv('COG_counts.csv', index=False)
-
-    #####
-
-    # create combi dataframe with column name used for merging in loop
-    combi_pw = pd.DataFrame(columns = ['KEGG_Pathway'])
+    # only the columns needed for the requested categories are read
+    chunksize = args.chunksize if args.streaming is True else None
 
     # loop over all files in wd that end with annotations
     for emapfile in entries:
         if emapfile.endswith('.annotations'):
             print('processing dataset ==> ',emapfile)
-            # open emapper.annotations file (skip first 3 rows)
-            sample = pd.read_csv(emapfile, sep='\t', skiprows=3)
-            # select only query_name and KEGG_ko column
-            select = sample.loc[:,['#query_name','KEGG_Pathway']]
-            # drop all lines where KEGG_ko is NaN
-            select = select[select['KEGG_Pathway'].notna()]
-            select = select.replace(to_replace =',map.*', value = '', regex = True) 
-
-            # iterate over each row to split KEGG_ko column by ',' and concatenate into new file 
-            splitted = pd.concat([pd.Series(row['#query_name'], row['KEGG_Pathway'].split(','))              
-                for _, row in select.iterrows()]).reset_index()
-            # rename columns
-            splitted.columns = ['KEGG_Pathway', 'query_name']
-            
-            # calculate counts for every KO 
-            pw_counts = pd.DataFrame(splitted['KEGG_Pathway'].value_counts()).rename_axis('KEGG_Pathway', axis=0)
-            pw_counts.columns = [str(emapfile).replace('.emapper.annotations','')]
-
-            # loop over merging the KO counts of all input files into the dataframe combi
-            combi_pw = pd.merge(combi_pw, pw_counts, how='outer', on='KEGG_Pathway')
-            
-            # if set save KOs and counts to separate files
-            if args.single is True:
-                print('saving KEGG Pathway counts for single dataset: ', str(emapfile).replace('.emapper.annotations',''))
-                pw_counts.to_csv(emapfile + '.KEGG-Pathway-counts.csv')
+            samplename = str(emapfile).replace('.emapper.annotations','')
+            samplenames.append(samplename)
+
+            # with --cache-dir take the counts of unchanged datasets from the cache
+            results = {}
+            if args.cache_dir is not None:
+                digest = file_digest(emapfile)
+                cachefiles = {}
+                for cat in counted:
+                    category = CATEGORIES[cat]
+                    tag = '%s\t%s\t%s\t%s' % (cat, category['column'], category['replace'], category['split'])
+                    cachefiles[cat] = cache_name(args.cache_dir, emapfile, tag)
+                    counts = load_cached_counts(cachefiles[cat], digest)
+                    if counts is not None:
+                        results[cat] = counts
+            missing = [cat for cat in counted if cat not in results]
+
+            if len(missing) > 0:
+                # open emapper.annotations file, with --streaming in chunks of at most chunksize rows
+                tables = read_annotations(emapfile, ['#query_name'] + [CATEGORIES[cat]['column'] for cat in missing], chunksize)
+                if chunksize is None:
+                    tables = [tables]
+                # split the category columns and count all categories from the same table
+                counters = {}
+                for cat in missing:
+                    counters[cat] = EntryCounter(CATEGORIES[cat]['split'])
+                for sample in tables:
+                    for cat in missing:
+                        counters[cat].update(category_values(sample, CATEGORIES[cat]))
+                for cat in missing:
+                    results[cat] = counters[cat].result()
+                    if args.cache_dir is not None:
+                        save_cached_counts(cachefiles[cat], digest, results[cat])
+
+            for cat in counted:
+                category = CATEGORIES[cat]
+                counts = pd.DataFrame(results[cat]).rename_axis(category['name'], axis=0)
+                counts.columns = [samplename]
+                sample_counts[cat].append(counts[samplename])
+
+                # if set save counts to separate files
+                if args.single is True:
+                    print('saving', category['label'], 'counts for single dataset: ', samplename)
+                    counts.to_csv(emapfile + category['single'])
 
         else:
             continue
 
-    # rename column to comply with microbiomeanalyst input
-    combi_pw.rename(columns={'KEGG_Pathway': '#NAME'}, inplace=True)
-    # replace missing values with 0
-    combi_pw = combi_pw.fillna(0)
-    # save KO counts
-    print('\nsaving merged KEGG Pathway counts to KEGG_Pathway_counts.csv\n')
-    combi_pw.to_csv('KEGG_Pathway_counts.csv', index=False)
-
-    #####
-
-    # create combi dataframe with column name used for merging in loop
-    combi_cazy = pd.DataFrame(columns = ['CAZy'])
-
-    # loop over all files in wd that end with annotations
-    for emapfile in entries:
-        if emapfile.endswith('.annotations'):
-            print('processing dataset ==> ',emapfile)
-            # open emapper.annotations file (skip first 3 rows)
-            sample = pd.read_csv(emapfile, sep='\t', skiprows=3)
-            # select only query_name and KEGG_ko column
-            select = sample.loc[:,['#query_name','CAZy']]
-            # drop all lines where KEGG_ko is NaN
-            select = select[select['CAZy'].notna()]
-            #select = select.replace(to_replace ='', value = '', regex = True) 
-
-            # iterate over each row to split KEGG_ko column by ',' and concatenate into new file 
-            splitted = pd.concat([pd.Series(row['#query_name'], row['CAZy'].split(','))              
-                for _, row in select.iterrows()]).reset_index()
-            # rename columns
-            splitted.columns = ['CAZy', 'query_name']
-            
-            # calculate counts for every KO 
-            cazy_counts = pd.DataFrame(splitted['CAZy'].value_counts()).rename_axis('CAZy', axis=0)
-            cazy_counts.columns = [str(emapfile).replace('.emapper.annotations','')]
-
-            # loop over merging the KO counts of all input files into the dataframe combi
-            combi_cazy = pd.merge(combi_cazy, cazy_counts, how='outer', on='CAZy')
-            
-            # if set save KOs and counts to separate files
-            if args.single is True:
-                print('saving CAZy counts for single dataset: ', str(emapfile).replace('.emapper.annotations',''))
-                cazy_counts.to_csv(emapfile + '.CAZy-counts.csv')
-
-        else:
+    if args.cache_dir is not None:
+        prune_cache(args.cache_dir, args.cache_size * 1024 * 1024)
+
+    # build the feature x sample matrices
+    combis = {}
+    for cat in counted:
+        combis[cat] = CountMatrix(samplenames, sample_counts[cat])
+
+    for cat in categories:
+        category = CATEGORIES[cat]
+        if cat in rollups:
+            # pathways or modules from the KO x sample matrix with one sparse matrix product
+            kos = combis['ko'].to_frame('#NAME', as_merged=False)
+            targets, counts = rollup(kos['#NAME'], kos[samplenames].to_numpy(), mappings[cat], args.split_weight)
+            if args.split_weight is False:
+                counts = counts.astype('int64')
+            combi = pd.DataFrame(counts, columns=samplenames)
+            combi.insert(0, '#NAME', targets)
+            print('\nsaving', category['label'], 'counts rolled up from the KO counts to', category['combined'] + '\n')
+            combi.to_csv(category['combined'], index=False)
+            if args.sparse_out is not None:
+                # non-zero counts of every sample, the rows are all pathways or modules of the table
+                rolled = CountMatrix(samplenames, [pd.Series(counts[:, i], index=targets)[counts[:, i] != 0]
+                    for i in range(len(samplenames))], targets)
+                rolled.save(category['combined'].replace('.csv', '.' + args.sparse_out))
             continue
-
-    # rename column to comply with microbiomeanalyst input
-    combi_cazy.rename(columns={'CAZy': '#NAME'}, inplace=True)
-    # replace missing values with 0
-    combi_cazy = combi_cazy.fillna(0)
-    # save KO counts
-    print('\nsaving merged CAZy counts to CAZy_counts.csv\n')
-    combi_cazy.to_csv('CAZy_counts.csv', index=False)
+        # first column named to comply with microbiomeanalyst input
+        combi = combis[cat]
+        # save counts
+        print('\nsaving merged', category['label'], 'counts to', category['combined'] + '\n')
+        combi.to_frame('#NAME').to_csv(category['combined'], index=False)
+        if args.sparse_out is not None:
+            combi.save(category['combined'].replace('.csv', '.' + args.sparse_out))
 
     # bye bye
     print('\nAll done - bye bye!')
@@ -0,0 +1,47 @@
+#!/usr/bin/python3
+
+import pandas as pd
+import sys
+import argparse
+
+from emapper_utils import read_mapping, rollup
+
+def main(argv):
+
+    # define user input
+    parser = argparse.ArgumentParser(description='roll a KO x sample table up into KEGG pathways or modules with a local KO -> pathway/module mapping file')
+    parser.add_argument('-t', '--table', required=True, help='KO x sample table. count: KEGG_ko_counts.csv of KO_from_emapper.py/KO_pathways_from_emapper.py, coverage: KEGG_ko tables of covsumEggNOG.py (_matrix.csv or _only-cov.csv)')
+    parser.add_argument('-m', '--mapping', required=True, help='tab-separated KO -> pathway or module mapping file (e.g. KEGG link/pathway/ko or link/module/ko)')
+    parser.add_argument('-o', '--output', required=True, help='output table, same layout as the input table')
+    parser.add_argument('-w', '--weight', choices=['count','coverage'], default='count', help='count: gene counts per KO (comma-separated, first column #NAME), coverage: summed gene coverage per KO (tab-separated, first column clusterID) [default count]')
+    parser.add_argument('--split-weight', action='store_true', help='divide the weight of a KO evenly among its pathways or modules instead of adding it to each')
+
+    args = parser.parse_args()
+
+    # import KO table and mapping
+    if args.weight == 'count':
+        sep = ','
+    else:
+        sep = '\t'
+    table = pd.read_csv(args.table, sep=sep)
+    name = table.columns[0]
+    samples = list(table.columns[1:])
+    mapping = read_mapping(args.mapping)
+
+    # KOs of the coverage tables keep the ko: prefix of the emapper output
+    kos = table[name].astype(str).str.replace('^ko:', '', regex=True)
+
+    # pathways or modules with one sparse matrix product
+    targets, values = rollup(kos, table[samples].to_numpy(dtype='float64'), mapping, args.split_weight)
+    if args.weight == 'count' and args.split_weight is False:
+        values = values.round().astype('int64')
+
+    result = pd.DataFrame(values, columns=samples)
+    result.insert(0, name, targets)
+    print('saving', len(result), 'pathways/modules rolled up from', len(table), 'KOs to', args.output)
+    result.to_csv(args.output, index=False, sep=sep)
+
+    # bye bye
+    print('\nAll done - bye bye!')
+
+if __name__ == "__main__": main(sys.argv[1:])
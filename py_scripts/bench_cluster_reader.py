@@ -0,0 +1,81 @@
+#!/usr/bin/python3
+
+# compares the readers of the cluster file in covsumCluster.py (python engine with
+# regular expression separator, C engine splitting at whitespace and pyarrow) on a
+# synthetic cluster file (10 columns, cluster ID in column 2 and gene ID in column 9)
+
+import os
+import sys
+import argparse
+import random
+import tempfile
+import time
+
+from covsumCluster import read_clusters
+
+# write a synthetic cluster file with num_lines lines
+def write_clusters(filename, num_lines, num_clusters):
+    rng = random.Random(42)
+    out = open(filename, 'w')
+    block = 100000
+    for start in range(0, num_lines, block):
+        out.write(''.join('S\tclu%i\t100\t*\t*\t*\t*\t*\tk141_%i\t*\n' % (rng.randrange(num_clusters), i)
+            for i in range(start, min(start + block, num_lines))))
+    out.close()
+
+# time one reader, returns seconds and number of rows
+def time_reader(filename, reader):
+    start = time.perf_counter()
+    table = read_clusters(filename, 1, 8, reader)
+    return time.perf_counter() - start, len(table)
+
+def main(argv):
+
+    parser = argparse.ArgumentParser(description='benchmark the readers of the cluster file of covsumCluster.py')
+    parser.add_argument('-n', '--lines', type=int, default=100000000, help='number of lines of the synthetic cluster file [default 100000000]')
+    parser.add_argument('-c', '--clusters', type=int, default=1000000, help='number of clusters in the synthetic cluster file [default 1000000]')
+    parser.add_argument('-p', '--python-lines', type=int, default=1000000, help='number of lines read with the slow python engine, its time is scaled to the size of the full file [default 1000000]')
+    parser.add_argument('-f', '--file', help='use this cluster file instead of writing a synthetic one')
+    parser.add_argument('-k', '--keep', action='store_true', help='keep the synthetic cluster files (directory is printed)')
+
+    args = parser.parse_args()
+
+    tmpdir = tempfile.mkdtemp()
+    if args.file is not None:
+        filename = args.file
+    else:
+        filename = os.path.join(tmpdir, 'clusters.txt')
+        print('writing synthetic cluster file with', args.lines, 'lines to', filename)
+        write_clusters(filename, args.lines, args.clusters)
+
+    # the python engine is timed on the first lines only
+    sample = os.path.join(tmpdir, 'clusters.head.txt')
+    with open(filename) as infile, open(sample, 'w') as out:
+        for i, line in zip(range(args.python_lines), infile):
+            out.write(line)
+
+    t_python, rows_python = time_reader(sample, 'python')
+    rate_python = rows_python / t_python
+    print('python engine (regex separator): %10.0f lines/s (%i lines in %.3f s)' % (rate_python, rows_python, t_python))
+
+    readers = [('c', 'C engine (whitespace):          ')]
+    try:
+        import pyarrow
+        readers.append(('pyarrow', 'pyarrow CSV (tab):              '))
+    except ImportError:
+        print('pyarrow not installed, skipping the pyarrow reader')
+    for reader, label in readers:
+        t_reader, rows = time_reader(filename, reader)
+        rate = rows / t_reader
+        print('%s %10.0f lines/s (%i lines in %.3f s, python engine estimated %.1f s), speedup %.2fx'
+            % (label, rate, rows, t_reader, rows / rate_python, rate / rate_python))
+
+    if args.keep is True:
+        print('synthetic cluster files kept in', tmpdir)
+    else:
+        for name in os.listdir(tmpdir):
+            os.remove(os.path.join(tmpdir, name))
+        os.rmdir(tmpdir)
+
+
+if __name__ == "__main__": main(sys.argv[1:])
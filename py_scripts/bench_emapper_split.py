@@ -0,0 +1,107 @@
+#!/usr/bin/python3
+
+# compares the per-row iterrows split of the emapper scripts with the vectorized
+# routines in emapper_utils.py on synthetic annotation files
+
+import os
+import sys
+import argparse
+import random
+import tempfile
+import time
+
+import pandas as pd
+
+from emapper_utils import count_entries, explode_entries
+
+# header of the emapper annotation files (22 columns)
+HEADER = ['#query_name', 'seed_eggNOG_ortholog', 'seed_ortholog_evalue', 'seed_ortholog_score',
+    'best_tax_level', 'Preferred_name', 'GOs', 'EC', 'KEGG_ko', 'KEGG_Pathway', 'KEGG_Module',
+    'KEGG_Reaction', 'KEGG_rclass', 'BRITE', 'KEGG_TC', 'CAZy', 'BiGG_Reaction', 'taxonomic scope',
+    'eggNOG OGs', 'best eggNOG OG', 'COG Functional cat.', 'eggNOG free text desc.']
+
+# write a synthetic emapper annotation file with random KOs, pathways and COG categories
+def write_annotations(filename, num_rows, seed):
+    rng = random.Random(seed)
+    cogs = 'ABCDEFGHIJKLMNOPQRSTUVWXYZ'
+    out = open(filename, 'w')
+    out.write('# emapper version: synthetic\n# command: synthetic\n# time: synthetic\n')
+    out.write('\t'.join(HEADER) + '\n')
+    for i in range(num_rows):
+        row = [''] * len(HEADER)
+        row[0] = 'k141_%i' % i
+        if rng.random() < 0.7:
+            row[8] = ','.join('ko:K%05i' % rng.randint(1, 20000) for _ in range(rng.randint(1, 4)))
+            row[9] = ','.join('ko%05i' % rng.randint(1, 1000) for _ in range(rng.randint(1, 6)))
+        if rng.random() < 0.9:
+            row[20] = ''.join(rng.sample(cogs, rng.randint(1, 3)))
+        out.write('\t'.join(row) + '\n')
+    out.write('## 3 queries scanned\n## Total time (seconds): 1\n## Rate: 1 q/s\n')
+    out.close()
+
+# the original per-row split
+def iterrows_counts(select, column, split):
+    if split == '':
+        splitted = pd.concat([pd.Series(row['#query_name'], list(row[column]))
+            for _, row in select.iterrows()]).reset_index()
+    else:
+        splitted = pd.concat([pd.Series(row['#query_name'], row[column].split(split))
+            for _, row in select.iterrows()]).reset_index()
+    splitted.columns = [column, 'query_name']
+    return splitted, splitted[column].value_counts()
+
+def main(argv):
+
+    parser = argparse.ArgumentParser(description='benchmark the iterrows split against the vectorized split of emapper categories')
+    parser.add_argument('-n', '--rows', type=int, default=50000, help='number of rows of each synthetic annotation file [default 50000]')
+    parser.add_argument('-f', '--files', type=int, default=1, help='number of synthetic annotation files [default 1]')
+    parser.add_argument('-k', '--keep', action='store_true', help='keep the synthetic annotation files (directory is printed)')
+
+    args = parser.parse_args()
+
+    tmpdir = tempfile.mkdtemp()
+    print('writing', args.files, 'synthetic annotation files with', args.rows, 'rows to', tmpdir)
+    files = []
+    for i in range(args.files):
+        filename = os.path.join(tmpdir, 'sample%i.emapper.annotations' % i)
+        write_annotations(filename, args.rows, i)
+        files.append(filename)
+
+    t_rows = 0.0
+    t_vect = 0.0
+    for filename in files:
+        sample = pd.read_csv(filename, sep='\t', skiprows=3, comment='#', names=HEADER,
+            usecols=['#query_name', 'KEGG_ko', 'COG Functional cat.'])
+        for column, split in [('KEGG_ko', ','), ('COG Functional cat.', '')]:
+            select = sample.loc[:,['#query_name',column]]
+            select = select[select[column].notna()]
+
+            start = time.perf_counter()
+            splitted, counts_rows = iterrows_counts(select, column, split)
+            t_rows += time.perf_counter() - start
+
+            start = time.perf_counter()
+            exploded = explode_entries(select['#query_name'], select[column], split)
+            counts_vect = count_entries(select[column], split)
+            t_vect += time.perf_counter() - start
+
+            if (exploded['entry'].tolist() != splitted[column].tolist()
+                    or exploded['id'].tolist() != splitted['query_name'].tolist()
+                    or not counts_rows.reset_index(drop=True).equals(counts_vect.reset_index(drop=True))
+                    or counts_rows.index.tolist() != counts_vect.index.tolist()):
+                print('ERROR: split results disagree for', column, 'in', filename)
+                sys.exit(1)
+
+    print('iterrows split:   %8.3f s' % t_rows)
+    print('vectorized split: %8.3f s' % t_vect)
+    print('speedup:          %8.2fx' % (t_rows / t_vect))
+
+    if args.keep is True:
+        print('synthetic annotation files kept in', tmpdir)
+    else:
+        for filename in files:
+            os.remove(filename)
+        os.rmdir(tmpdir)
+
+
+if __name__ == "__main__": main(sys.argv[1:])
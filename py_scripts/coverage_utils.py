@@ -0,0 +1,184 @@
+#!/usr/bin/python3
+
+# shared helpers for summing gene coverage per cluster or category (covsumCluster.py, covsumEggNOG.py)
+
+import os
+import mmap
+import struct
+
+import numpy as np
+import pandas as pd
+
+# first bytes of the binary cluster index files (write_cluster_index)
+CIDX_MAGIC = b'CIDX2\n\0\0'
+
+# gene hash scheme of the cluster index: pandas hash_array with this key on UTF-8 gene IDs
+#   the hash of GENE_HASH_PROBE is stored in the index and compared on load, an index
+#   written by a pandas version with a different hash can not be read
+GENE_HASH_KEY = '0123456789123456'
+GENE_HASH_PROBE = ['covsumCluster', 'gene_0001', 'k141_42_1 \u00e9']
+
+# read the gene coverage table (columns D: gene ID and E: coverage, 0-based)
+def read_coverage(filename, D, E):
+    return pd.read_csv(filename,
+        sep='\t',
+        usecols=[D,E],
+        index_col=False,
+        header=None,
+        names=['geneID','coverage'],
+        dtype={'geneID': str})
+
+# gene IDs of the coverage table interned into integer codes
+#   genes: hash index of the gene IDs, the code of a gene is its position
+#   coverage: float64 coverage of every code (summed if a gene is listed more than once)
+class CoverageIndex(object):
+    def __init__(self, cov):
+        coverage = cov['coverage'].astype(np.float64).groupby(cov['geneID'], sort=False).sum()
+        self.genes = coverage.index
+        self.coverage = coverage.to_numpy(dtype=np.float64)
+    # codes of gene IDs, -1 for genes without coverage
+    def lookup(self, genes):
+        return self.genes.get_indexer(pd.Index(genes).astype(str))
+
+# coverage sums per cluster, accumulated chunk by chunk from (cluster ID, gene ID) pairs
+#   clusters: code of every cluster ID in order of first occurrence
+#   with unique_pairs a gene counts only once per cluster (as after drop_duplicates), this
+#   keeps one int64 key per distinct pair with coverage, otherwise only the float64 sums are kept
+class ClusterSums(object):
+    def __init__(self, index, unique_pairs=False):
+        self.index = index
+        self.unique_pairs = unique_pairs
+        self.clusters = {}
+        self.sums = np.zeros(0, dtype=np.float64)
+        self.keys = []
+    def add(self, clusters, genes):
+        clusters = pd.Series(clusters).astype(str)
+        # code of every cluster ID of the chunk
+        chunk_codes, uniques = pd.factorize(clusters)
+        ids = np.array([self.clusters.setdefault(cluster, len(self.clusters)) for cluster in uniques], dtype=np.int64)
+        cluster_codes = ids[chunk_codes]
+        gene_codes = self.index.lookup(genes)
+        # genes without coverage add nothing
+        found = gene_codes >= 0
+        cluster_codes = cluster_codes[found]
+        gene_codes = gene_codes[found]
+        if self.unique_pairs is True:
+            self.keys.append(np.unique(cluster_codes * len(self.index.coverage) + gene_codes))
+            return
+        # (bincount returns int64 for empty weights)
+        sums = np.bincount(cluster_codes, weights=self.index.coverage[gene_codes], minlength=len(self.clusters)).astype(np.float64)
+        sums[:len(self.sums)] += self.sums
+        self.sums = sums
+    # coverage sums of all clusters, sorted by cluster ID
+    # with numeric, cluster IDs that are all numbers are sorted as numbers (as when read by pandas)
+    def result(self, numeric=False):
+        if self.unique_pairs is True:
+            keys = np.unique(np.concatenate(self.keys)) if self.keys else np.zeros(0, dtype=np.int64)
+            num_genes = max(1, len(self.index.coverage))
+            self.sums = np.bincount(keys // num_genes, weights=self.index.coverage[keys % num_genes],
+                minlength=len(self.clusters))
+        sums = np.zeros(len(self.clusters), dtype=np.float64)
+        sums[:len(self.sums)] = self.sums
+        # missing coverage counts as 0
+        sums = np.nan_to_num(sums)
+        names = pd.Index(list(self.clusters), dtype=object)
+        if numeric is True and len(names) > 0:
+            numbers = pd.to_numeric(names, errors='coerce')
+            if not numbers.isna().any():
+                names = numbers
+        result = pd.Series(sums, index=names.rename('clusterID'), name='sum_coverage')
+        return result.sort_index()
+
+# cluster membership interned into integer codes, built once to sum many coverage tables
+#   clusters: sorted cluster IDs, genes: hash index of all member gene IDs
+#   pair_clusters, pair_genes: cluster and gene code of every membership
+class MemberIndex(object):
+    def __init__(self, clusters, genes):
+        self.pair_clusters, self.clusters = pd.factorize(pd.Series(clusters), sort=True)
+        self.pair_genes, self.genes = pd.factorize(pd.Series(genes).astype(str))
+    # summed coverage of every cluster for one coverage table (missing coverage counts as 0)
+    def sum_coverage(self, cov):
+        codes = self.genes.get_indexer(cov['geneID'].astype(str))
+        found = codes >= 0
+        coverage = np.nan_to_num(cov['coverage'].to_numpy(dtype=np.float64)[found])
+        gene_coverage = np.bincount(codes[found], weights=coverage, minlength=len(self.genes)).astype(np.float64)
+        return np.bincount(self.pair_clusters, weights=gene_coverage[self.pair_genes], minlength=len(self.clusters)).astype(np.float64)
+
+# 64-bit hashes of gene IDs (pandas hash_array with GENE_HASH_KEY, the same in every run)
+def hash_genes(genes):
+    return pd.util.hash_array(np.asarray(pd.Series(genes).astype(str), dtype=object),
+        encoding='utf8', hash_key=GENE_HASH_KEY, categorize=False)
+
+# combined hash of GENE_HASH_PROBE, changes with the gene hash scheme
+def gene_hash_check():
+    return int(np.bitwise_xor.reduce(hash_genes(GENE_HASH_PROBE) * np.arange(1, len(GENE_HASH_PROBE) + 1, dtype=np.uint64)))
+
+# compile cluster membership into a binary index file read with ClusterIndex
+#   layout: magic, number of pairs n, number of clusters, length of the names, gene hash check,
+#   n uint64 gene hashes (sorted), n int64 cluster codes, cluster names joined by newlines
+# every (cluster, gene) pair is stored once; returns False if two gene IDs have the same hash
+def write_cluster_index(filename, clusters, genes):
+    codes, names = pd.factorize(pd.Series(clusters), sort=True)
+    genes = np.asarray(pd.Series(genes).astype(str), dtype=object)
+    hashes = hash_genes(genes)
+    # sort the pairs by gene hash and cluster code, drop repeated pairs
+    order = np.lexsort((codes, hashes))
+    hashes = hashes[order]
+    codes = codes[order].astype(np.int64)
+    genes = genes[order]
+    same_hash = hashes[1:] == hashes[:-1]
+    if (same_hash & (genes[1:] != genes[:-1])).any():
+        return False
+    keep = np.ones(len(hashes), dtype=bool)
+    keep[1:] = ~(same_hash & (codes[1:] == codes[:-1]))
+    hashes = hashes[keep]
+    codes = codes[keep]
+    num_clusters = len(names)
+    names = '\n'.join(str(name) for name in names).encode()
+    tmpname = '%s.%i.tmp' % (filename, os.getpid())
+    with open(tmpname, 'wb') as outfile:
+        outfile.write(CIDX_MAGIC)
+        outfile.write(struct.pack('<qqqQ', len(hashes), num_clusters, len(names), gene_hash_check()))
+        outfile.write(hashes.astype('<u8').tobytes())
+        outfile.write(codes.astype('<i8').tobytes())
+        outfile.write(names)
+    os.replace(tmpname, filename)
+    return True
+
+# memory-mapped binary cluster index (see write_cluster_index), nothing is parsed when loading
+class ClusterIndex(object):
+    def __init__(self, filename):
+        with open(filename, 'rb') as infile:
+            self.buffer = mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.buffer[:len(CIDX_MAGIC)] != CIDX_MAGIC:
+            raise ValueError('%s is not a cluster index of this version, rebuild it with "covsumCluster.py index"' % filename)
+        pos = len(CIDX_MAGIC)
+        num_pairs, self.num_clusters, names_length, hash_check = struct.unpack_from('<qqqQ', self.buffer, pos)
+        pos += 32
+        if hash_check != gene_hash_check():
+            raise ValueError('%s was written with a different gene hash (pandas %s hashes differently), rebuild it with "covsumCluster.py index"' % (filename, pd.__version__))
+        self.hashes = np.frombuffer(self.buffer, dtype='<u8', count=num_pairs, offset=pos)
+        pos += 8 * num_pairs
+        self.pair_clusters = np.frombuffer(self.buffer, dtype='<i8', count=num_pairs, offset=pos)
+        pos += 8 * num_pairs
+        self.names_offset = pos
+        self.names_length = names_length
+    # cluster IDs in the order of their codes
+    def cluster_names(self):
+        if self.names_length == 0:
+            return []
+        return self.buffer[self.names_offset:self.names_offset + self.names_length].decode().split('\n')
+    # number of gene IDs that are members of at least one cluster
+    def count_members(self, genes):
+        hashes = hash_genes(genes)
+        return int((np.searchsorted(self.hashes, hashes, side='right') > np.searchsorted(self.hashes, hashes, side='left')).sum())
+    # summed coverage of every cluster for one coverage table (missing coverage counts as 0)
+    def sum_coverage(self, cov):
+        hashes = hash_genes(cov['geneID'])
+        first = np.searchsorted(self.hashes, hashes, side='left')
+        counts = np.searchsorted(self.hashes, hashes, side='right') - first
+        # one position per (coverage row, cluster of its gene)
+        starts = np.repeat(first - np.cumsum(counts) + counts, counts)
+        positions = starts + np.arange(counts.sum())
+        coverage = np.repeat(np.nan_to_num(cov['coverage'].to_numpy(dtype=np.float64)), counts)
+        return np.bincount(self.pair_clusters[positions], weights=coverage, minlength=self.num_clusters).astype(np.float64)
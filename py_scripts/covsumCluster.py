@@ -5,16 +5,127 @@ import sys
 import argparse
 import datetime
 
+import numpy as np
+
+from coverage_utils import read_coverage, CoverageIndex, ClusterSums, ClusterIndex, write_cluster_index
+
+# import cluster file, only the columns A (cluster ID) and B (gene ID) are parsed
+#   reader 'c': pandas C engine splitting at runs of whitespace
+#   reader 'pyarrow': multi-threaded pyarrow CSV reader, tab-separated files without comment lines only
+#   reader 'python': python engine with a regular expression separator (slow)
+# gene IDs are read as strings (as in read_coverage), IDs like 0123 keep their leading zeros
+# with chunksize an iterator over tables of about chunksize rows is returned
+def read_clusters(filename, A, B, reader='c', chunksize=None):
+    if A < B:
+        columnnames=['clusterID','geneID']
+    else:
+        columnnames=['geneID','clusterID']
+    if reader == 'pyarrow':
+        try:
+            import pyarrow as pa
+            from pyarrow import csv
+        except ImportError:
+            print("--reader pyarrow requires pyarrow to be installed")
+            print(" == EXITING == ")
+            exit()
+        options = dict(read_options=csv.ReadOptions(autogenerate_column_names=True),
+            parse_options=csv.ParseOptions(delimiter='\t'),
+            convert_options=csv.ConvertOptions(include_columns=['f%i' % A, 'f%i' % B],
+                column_types={'f%i' % B: pa.string()}))
+        rename = {'f%i' % A: 'clusterID', 'f%i' % B: 'geneID'}
+        if chunksize is not None:
+            # record batches of the pyarrow block size
+            return (batch.to_pandas().rename(columns=rename)[columnnames] for batch in csv.open_csv(filename, **options))
+        return csv.read_csv(filename, **options).to_pandas().rename(columns=rename)[columnnames]
+    if reader == 'python':
+        sep = r'\s|t'
+    else:
+        sep = r'\s+'
+    return pd.read_csv(filename, 
+        sep=sep, 
+        usecols=[A,B],
+        index_col=False, 
+        header=None, 
+        names=columnnames,
+        dtype={'geneID': str},
+        engine=reader,
+        comment='#',
+        chunksize=chunksize)
+
+# sum the coverage of every cluster from cluster codes with np.bincount
+#   combi: one row per cluster member with clusterID, geneID and coverage
+# returns the sorted cluster names, the code of every row and the summed coverage per cluster
+def sum_by_codes(combi):
+    codes, clusters = pd.factorize(combi['clusterID'], sort=True)
+    member = codes >= 0
+    codes = codes[member]
+    # missing coverage counts as 0 (as in the groupby sum), but is listed as nan in the members
+    coverage = np.nan_to_num(combi['coverage'].to_numpy(dtype=np.float64)[member])
+    sums = np.bincount(codes, weights=coverage, minlength=len(clusters))
+    return clusters, codes, member, sums
+
+# write the members and coverages of every cluster one cluster at a time
+# (same layout as cluster_coverage.csv of the groupby path, members sorted by gene ID)
+def write_members(filename, combi, clusters, codes, member, sums):
+    genes = combi['geneID'].astype(str).to_numpy(dtype=object)[member]
+    order = np.lexsort((genes, codes))
+    genes = genes[order]
+    coverage = combi['coverage'].to_numpy(dtype=np.float64)[member][order]
+    ends = np.cumsum(np.bincount(codes, minlength=len(clusters)))
+    out = open(filename, 'w')
+    out.write('clusterID\tgeneID\tcoverage\tsum_coverage\n')
+    start = 0
+    for cluster, end, total in zip(clusters, ends.tolist(), sums.tolist()):
+        out.write('%s\t%s\t%s\t%r\n' % (cluster, genes[start:end].tolist(), coverage[start:end].tolist(), total))
+        start = end
+    out.close()
+
+# covsumCluster.py index: compile the cluster file once into a binary index for -i/--index
+def index_main(argv):
+
+    # define user input
+    parser = argparse.ArgumentParser(prog='covsumCluster.py index', description='compile a cluster file into a memory-mapped binary index of gene ID hashes, cluster codes and cluster names')
+    parser.add_argument('-c', '--clustfile', required=True, help='file containing the gene clusters. assumes cluster ID in column a [default 2] and gene ID in column b [default 9]')
+    parser.add_argument('-a', '--clustIDcolumn', type=int, default=2, help='column with cluster ID in file containing the gene clusters [default 2]')
+    parser.add_argument('-b', '--geneIDcolumn', type=int, default=9, help='column with gene ID in file containing the gene clusters [default 9]')
+    parser.add_argument('-o', '--output', required=True, help='binary index file to write')
+    parser.add_argument('--reader', choices=['c','pyarrow','python'], default='c', help='reader of the cluster file (see covsumCluster.py -h) [default c]')
+
+    args = parser.parse_args(argv)
+
+    now = datetime.datetime.now().strftime("[%Y-%m-%d %H:%M:%S]")
+    print(now," Indexing gene clusters of", args.clustfile)
+
+    input = read_clusters(args.clustfile, args.clustIDcolumn - 1, args.geneIDcolumn - 1, args.reader)
+    if write_cluster_index(args.output, input['clusterID'], input['geneID']) is False:
+        print("Two gene IDs have the same 64 bit hash, the cluster file can not be indexed")
+        print(" == EXITING == ")
+        exit()
+
+    # bye bye
+    print('\nIndex saved to', args.output, '- bye bye!')
+
 def main(argv):
 
+    # covsumCluster.py index ...
+    if len(argv) > 0 and argv[0] == 'index':
+        index_main(argv[1:])
+        return
+
     # define user input
-    parser = argparse.ArgumentParser(description='get cluster coverage sums of all genes in a cluster')
+    parser = argparse.ArgumentParser(description='get cluster coverage sums of all genes in a cluster. Run "covsumCluster.py index -h" to compile a cluster file into a reusable binary index')
     parser.add_argument('-c', '--clustfile', help='file containing the gene clusters. assumes cluster ID in column a [default 2] and gene ID in column b [default 9]')
     parser.add_argument('-a', '--clustIDcolumn', type=int, default=2, help='column with cluster ID in file containing the gene clusters [default 2]')
     parser.add_argument('-b', '--geneIDcolumn', type=int, default=9, help='column with gene ID in file containing the gene clusters [default 9]')
     parser.add_argument('-g', '--genecov', help='file containing each gene (column d [default 1]) and its read coverage normalized by gene length (column e [default 2])')
     parser.add_argument('-d', '--genecolumn', type=int, default=1, help='column with gene ID in file containing coverage per gene [default 1]')
     parser.add_argument('-e', '--genecovcolumn', type=int, default=2, help='column with read coverage normalized by gene length [default 2]')   
+    parser.add_argument('-i', '--index', help='binary cluster index written by "covsumCluster.py index", used instead of -c. Only cluster_only-cov.csv is written. Numeric cluster IDs are written as in the cluster file (e.g. 2), the default path writes them as floats (2.0) when the coverage table has genes without a cluster')
+    parser.add_argument('--reader', choices=['c','pyarrow','python'], default='c', help='reader of the cluster file. c: C parser splitting columns at whitespace, pyarrow: fastest, for tab-separated files without comment lines (requires pyarrow), python: former regular expression parser [default c]')
+    parser.add_argument('--hash-join', action='store_true', help='intern the gene IDs of the coverage table into integer codes and stream the cluster file against them, only cluster_only-cov.csv is written. Memory grows with the number of genes, not with the size of the join. Numeric cluster IDs are written as in the cluster file (e.g. 2), the default path writes them as floats (2.0) when the coverage table has genes without a cluster')
+    parser.add_argument('--chunksize', type=int, default=1000000, help='number of rows of the cluster file per chunk with --hash-join [default 1000000]')
+    parser.add_argument('--fast', action='store_true', help='sum the coverage with cluster codes in one pass, without building per-cluster lists. cluster_coverage.csv is only written with --with-members. Numeric cluster IDs are written as in the cluster file (e.g. 2), the default path writes them as floats (2.0) when the coverage table has genes without a cluster')
+    parser.add_argument('--with-members', action='store_true', help='with --fast also write the members and coverages of every cluster to cluster_coverage.csv (members sorted by gene ID as in the default path)')
 
     args = parser.parse_args()
 
@@ -26,42 +137,74 @@ def main(argv):
     now = datetime.datetime.now().strftime("[%Y-%m-%d %H:%M:%S]")
     print(now," Summing read coverage for genes within a gene cluster")
 
-    if A < B:
-        columnnames=['clusterID','geneID']
-    else:
-        columnnames=['geneID','clusterID']
+    if args.index is not None:
+        # memory-mapped cluster index, only the coverage table is parsed
+        try:
+            index = ClusterIndex(args.index)
+        except ValueError as error:
+            print(error)
+            print(" == EXITING == ")
+            exit()
+        cov = read_coverage(args.genecov, D, E)
+        # no gene of the coverage table in the index: wrong columns or an index of other gene IDs
+        if len(cov) > 0 and index.count_members(cov['geneID']) == 0:
+            print("Warning: none of the", len(cov), "genes of", args.genecov, "is a member of a cluster in", args.index, "- all sums are 0")
+        sums = index.sum_coverage(cov)
+
+        # export file to csv
+        cov_df_sumonly = pd.Series(sums, index=pd.Index(index.cluster_names(), name='clusterID'), name='sum_coverage')
+        cov_df_sumonly.to_csv('cluster_only-cov.csv', index=True, sep="\t")
+
+        # bye bye
+        print('\nAll done - bye bye!')
+        return
+
+    if args.hash_join is True:
+        # hash index of the genes in the coverage table
+        index = CoverageIndex(read_coverage(args.genecov, D, E))
+        # stream the cluster file against the index, every gene counts once per cluster
+        sums = ClusterSums(index, unique_pairs=True)
+        for chunk in read_clusters(args.clustfile, A, B, args.reader, args.chunksize):
+            sums.add(chunk['clusterID'], chunk['geneID'])
+
+        # export file to csv
+        sums.result(numeric=True).to_csv('cluster_only-cov.csv', index=True, sep="\t")
+
+        # bye bye
+        print('\nAll done - bye bye!')
+        return
 
     # import cluster file
-    input = pd.read_csv(args.clustfile, 
-        sep='\s|t', 
-        usecols=[A,B],
-        index_col=False, 
-        header=None, 
-        names=columnnames,
-        engine='python',
-        comment='#').drop_duplicates()
+    input = read_clusters(args.clustfile, A, B, args.reader).drop_duplicates()
 
-    # import gene coverage file
-    cov = pd.read_csv(args.genecov, 
-        sep='\t', 
-        usecols=[D,E], 
-        index_col=False, 
-        header=None, 
-        names=['geneID','coverage'])
+    # import gene coverage file (gene IDs as strings, as in the cluster file)
+    cov = read_coverage(args.genecov, D, E)
+
+    if args.fast is True:
+        # one row per cluster member, genes only in the coverage table belong to no cluster
+        combi = pd.merge(input, cov, how='left', on='geneID')
+        clusters, codes, member, sums = sum_by_codes(combi)
 
-    # combine cluster file and coverage table
-    combi = pd.merge(input, cov, how='outer', on='geneID')
+        # export files to csv
+        cov_df_sumonly = pd.Series(sums, index=pd.Index(clusters, name='clusterID'), name='sum_coverage')
+        cov_df_sumonly.to_csv('cluster_only-cov.csv', index=True, sep="\t")
+        if args.with_members is True:
+            write_members('cluster_coverage.csv', combi, clusters, codes, member, sums)
+
+    else:
+        # combine cluster file and coverage table
+        combi = pd.merge(input, cov, how='outer', on='geneID')
 
-    # sum coverage within each gene cluster
-    cov_df = combi.groupby(['clusterID']).agg(lambda x: x.tolist())
-    cov_df['sum_coverage'] = combi.groupby(['clusterID']).sum()
+        # sum coverage within each gene cluster
+        cov_df = combi.groupby(['clusterID']).agg(lambda x: x.tolist())
+        cov_df['sum_coverage'] = combi.groupby(['clusterID'])['coverage'].sum()
 
-    # subset to retriev summed coverage only
-    cov_df_sumonly = cov_df['sum_coverage']
+        # subset to retriev summed coverage only
+        cov_df_sumonly = cov_df['sum_coverage']
 
-    # export files to csv
-    cov_df.to_csv('cluster_coverage.csv', index=True, sep="\t")
-    cov_df_sumonly.to_csv('cluster_only-cov.csv', index=True, sep="\t")
+        # export files to csv
+        cov_df.to_csv('cluster_coverage.csv', index=True, sep="\t")
+        cov_df_sumonly.to_csv('cluster_only-cov.csv', index=True, sep="\t")
 
     # bye bye
     print('\nAll done - bye bye!')
@@ -1,20 +1,58 @@
 #!/usr/bin/env python3
 
 import pandas as pd
+import numpy as np
 import sys
 import argparse
 import datetime
 import os
+from multiprocessing import Pool
+
+from emapper_utils import explode_entries, annotation_columns, read_annotation_positions
+from coverage_utils import read_coverage, CoverageIndex, ClusterSums, MemberIndex
+
+# gene ID and category of all genes with an entry in category column A (0-based, inlist 1-based) of the
+# emapper table, one row per category of a gene
+def category_pairs(table, B, A, inlist):
+    input = pd.DataFrame({'geneID': table[B], 'clusterID': table[A]}).dropna().replace(to_replace =',map.*', value = '', regex = True) 
+
+    # split categories into separate rows
+    if inlist == 21 : # for COG categories split after every 'letter'
+        splitted = explode_entries(input['geneID'], input['clusterID'], '')
+    else: # for all others split at the comma
+        splitted = explode_entries(input['geneID'], input['clusterID'], ',')
+
+    # rename columns
+    return splitted.rename(columns={"entry":"clusterID", "id":"geneID"})
+
+# category indexes of the requested columns, set in the worker processes with --jobs
+worker_indexes = None
+
+def init_worker(indexes):
+    global worker_indexes
+    worker_indexes = indexes
+
+# summed coverage of every category of every requested column for one coverage file
+#   job: (coverage file, gene ID column, coverage column)
+# (runs in the worker processes with --jobs)
+def sum_sample(job):
+    genecov, D, E = job
+    cov = read_coverage(genecov, D, E)
+    return [index.sum_coverage(cov) for index in worker_indexes]
 
 def main(argv):
     # define user input
     parser = argparse.ArgumentParser(description='get cluster coverage sums of all genes in a category of EggNOGmapper output')
-    parser.add_argument('-c', '--clustfile', help='eggnog mapper output annotation file')
+    parser.add_argument('-c', '--clustfile', help='eggnog mapper output annotation file (its columnar file of emapper_to_parquet.py is read instead if it is up to date)')
     parser.add_argument('-a', '--clustIDcolumn', type=int, required=True, nargs='+', help='column with cluster ID in file containing the gene clusters. Valid columns are 7: Gene Ontology terms, 8: EC number, 9: KEGG_ko, 10: KEGG_Pathway, 11: KEGG_Module, 12: KEGG_Reaction, 13: KEGG_rclass, 14: BRITE, 15: KEGG_TC, 16.: CAZy, 17: BiGG Reaction, 19.: eggNOG OGs, 21: COG Functional Category,')
     parser.add_argument('-b', '--geneIDcolumn', type=int, default=1, help='column with gene ID in eggNOG annotation file [default 1]')
-    parser.add_argument('-g', '--genecov', help='file containing gene ID and its read coverage normalized by gene length')
+    parser.add_argument('-g', '--genecov', nargs='+', help='file(s) containing gene ID and its read coverage normalized by gene length. With more than one file one category x sample matrix of summed coverage is written per column, the samples are named by file name (without extension), which must be unique')
     parser.add_argument('-d', '--genecolumn', type=int, default=1, help='column with gene ID in file containing coverage per gene [default 1]')
     parser.add_argument('-e', '--genecovcolumn', type=int, default=2, help='column with read coverage normalized by gene length [default 2]')   
+    parser.add_argument('-o', '--outprefix', default='covsum', help='prefix of the category x sample matrices written for more than one coverage file [default covsum]')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='number of worker processes summing the coverage files in parallel [default 1]')
+    parser.add_argument('--hash-join', action='store_true', help='intern the gene IDs of the coverage table into integer codes and stream the annotation file against them, only the _only-cov.csv files are written. Memory grows with the number of genes, not with the size of the join. Only with one coverage file')
+    parser.add_argument('--chunksize', type=int, default=1000000, help='number of rows of the annotation file per chunk with --hash-join [default 1000000]')
 
     args = parser.parse_args()
 
@@ -31,70 +69,117 @@ def main(argv):
         print(" == EXITING == ")
         exit()
 
-    for inlist in args.clustIDcolumn:
-
-        A = inlist - 1
-        B = args.geneIDcolumn - 1
-        D = args.genecolumn - 1 
-        E = args.genecovcolumn - 1 
-
-        columnnames=["geneID","clusterID"] 
-        # import cluster (emapper) file
-        input = pd.read_csv(args.clustfile,
-            sep='\t', 
-            usecols=[B,A],
-            index_col=False, 
-            header=None, 
-            names=columnnames,
-            engine='python',
-            comment='#').dropna().replace(to_replace =',map.*', value = '', regex = True) 
-
-        # import headline from cluster (emapper) file to name category
-        headline = pd.read_csv(args.clustfile, 
-            sep='\t', 
-            index_col=False, 
-            header=None, 
-            engine='python',
-            skiprows=3,
-            nrows=1)
-        
+    B = args.geneIDcolumn - 1
+    D = args.genecolumn - 1 
+    E = args.genecovcolumn - 1 
+    columns = [inlist - 1 for inlist in args.clustIDcolumn]
+    # gene IDs are read as strings on both sides (as in read_coverage), IDs like 0123 keep their leading zeros
+    dtype = {B: str}
+
+    # import headline from cluster (emapper) file to name categories
+    headline = annotation_columns(args.clustfile)
+
+    if len(args.genecov) > 1:
+        # several coverage files are summed against an index of the categories, not streamed
+        if args.hash_join is True:
+            print("--hash-join works with one coverage file (-g), several files are summed with an index of the categories")
+            print(" == EXITING == ")
+            exit()
+        # samples are named by file name, the matrix columns need to be unique
+        samples = [os.path.splitext(os.path.basename(genecov))[0] for genecov in args.genecov]
+        repeated = sorted(set(sample for sample in samples if samples.count(sample) > 1))
+        if len(repeated) > 0:
+            print("Coverage files with the same name give the same sample name:", ','.join(repeated), "- please rename the files")
+            print(" == EXITING == ")
+            exit()
+
+        # import cluster (emapper) file once and index the categories of all requested columns
+        table = read_annotation_positions(args.clustfile, set([B] + columns), dtype=dtype)
+        indexes = []
+        for inlist, A in zip(args.clustIDcolumn, columns):
+            splitted = category_pairs(table, B, A, inlist)
+            indexes.append(MemberIndex(splitted['clusterID'], splitted['geneID']))
+        del table
+
+        now = datetime.datetime.now().strftime("[%Y-%m-%d %H:%M:%S]")
+        print(now," Summing read coverage of", len(args.genecov), "coverage files")
+
+        # coverage files are summed independently (in worker processes with --jobs)
+        jobs = [(genecov, D, E) for genecov in args.genecov]
+        if args.jobs > 1:
+            pool = Pool(args.jobs, initializer=init_worker, initargs=(indexes,))
+            results = pool.map(sum_sample, jobs)
+            pool.close()
+            pool.join()
+        else:
+            init_worker(indexes)
+            results = [sum_sample(job) for job in jobs]
+
+        # one category x sample matrix per requested column
+        for i, (A, index) in enumerate(zip(columns, indexes)):
+            cat = headline[A]
+            matrix = pd.DataFrame(np.column_stack([result[i] for result in results]),
+                index=pd.Index(index.clusters, name='clusterID'), columns=samples)
+            print('saving summed coverage of', cat, 'to', args.outprefix + '_' + cat + '_matrix.csv')
+            matrix.to_csv(args.outprefix + '_' + cat + '_matrix.csv', index=True, sep="\t")
+
+        # bye bye
+        print('\nAll done - bye bye!')
+        return
+
+    # name of the output files
+    name = os.path.basename(args.genecov[0])
+    name = os.path.splitext(name)[0]
+
+    if args.hash_join is True:
+        # hash index of the genes in the coverage table
+        index = CoverageIndex(read_coverage(args.genecov[0], D, E))
+        # stream the cluster (emapper) file against the index, all categories from the same chunks
+        sums = [ClusterSums(index) for A in columns]
+        for table in read_annotation_positions(args.clustfile, set([B] + columns), args.chunksize, dtype):
+            for inlist, A, category_sums in zip(args.clustIDcolumn, columns, sums):
+                splitted = category_pairs(table, B, A, inlist)
+                category_sums.add(splitted['clusterID'], splitted['geneID'])
+
+        for A, category_sums in zip(columns, sums):
+            cat = headline[A]
+            now = datetime.datetime.now().strftime("[%Y-%m-%d %H:%M:%S]")
+            print(now," Summed read coverage for genes belonging to categories of",cat)
+            # export file to csv
+            category_sums.result().to_csv(name + '_' + cat + '_only-cov.csv', index=True, sep="\t")
+
+        # bye bye
+        print('\nAll done - bye bye!')
+        return
+
+    # import cluster (emapper) file once with the gene ID and all requested category columns
+    # (from the columnar file of emapper_to_parquet.py if there is an up-to-date one)
+    table = read_annotation_positions(args.clustfile, set([B] + columns), dtype=dtype)
+
+    # import gene coverage table
+    cov = read_coverage(args.genecov[0], D, E)
+
+    for inlist, A in zip(args.clustIDcolumn, columns):
+
         now = datetime.datetime.now().strftime("[%Y-%m-%d %H:%M:%S]")
 
-        cat = headline[A].iloc[0]
+        cat = headline[A]
         print(now," Summing read coverage for genes belonging to categories of",cat)
 
-        # split categories into separate rows
-        if args.clustIDcolumn == 21 : # for COG categories split after every 'letter'
-            splitted = pd.concat([pd.Series(row['geneID'], list(row['clusterID']))              
-                for _, row in input.iterrows()]).reset_index()
-        else: # for all others split at the comma
-            splitted = pd.concat([pd.Series(row['geneID'], row['clusterID'].split(','))              
-                for _, row in input.iterrows()]).reset_index()
-
-        # rename columns
-        splitted = splitted.rename(columns={"index":"clusterID", 0:"geneID"})
-
-        # import gene coverage table
-        cov = pd.read_csv(args.genecov, 
-            sep='\t', 
-            usecols=[D,E], 
-            index_col=False, 
-            header=None, 
-            names=['geneID','coverage'])
+        # gene ID and category of all genes, one row per category of a gene
+        splitted = category_pairs(table, B, A, inlist)
 
         # combine cluster file and coverage table
         combi = pd.merge(splitted, cov, how='outer', on='geneID')
 
         # sum coverage per gene cluster or category
         cov_df = combi.groupby(['clusterID']).agg(lambda x: x.tolist())
-        cov_df['sum_coverage'] = combi.groupby(['clusterID']).sum()
+        cov_df['sum_coverage'] = combi.groupby(['clusterID'])['coverage'].sum()
 
         # subset to retriev summed coverage only
         cov_df_sumonly = cov_df['sum_coverage']
 
         # extort csv files
-        name = os.path.basename(args.genecov)
-        name = os.path.splitext(name)[0]
         cov_df.to_csv(name + '_' + cat + '_cov.csv', index=True, sep="\t")
         cov_df_sumonly.to_csv(name + '_' + cat + '_only-cov.csv', index=True, sep="\t")
 
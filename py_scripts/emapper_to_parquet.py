@@ -0,0 +1,43 @@
+#!/usr/bin/python3
+
+import sys
+import os
+import argparse
+import datetime
+
+from emapper_utils import write_columnar, columnar_name, has_columnar
+
+def main(argv):
+
+    # define user input
+    parser = argparse.ArgumentParser(description='convert emapper output *.annotations once into typed columnar Parquet files (<file>.parquet next to each annotation file). KO_from_emapper.py, KO_pathways_from_emapper.py and covsumEggNOG.py read only the columns they need from these files, as long as they are not older than the annotation file')
+    parser.add_argument('files', nargs='*', help='emapper annotation files to convert [default all *.annotations in the input directory]')
+    parser.add_argument('-i', '--inputdir', default='.', help='input directory containing emapper output *.annotations, used without files [default .]')
+    parser.add_argument('-f', '--force', action='store_true', help='convert files that already have an up-to-date Parquet file again')
+
+    args = parser.parse_args()
+
+    try:
+        import pyarrow
+    except ImportError:
+        print("emapper_to_parquet.py requires pyarrow to be installed")
+        print(" == EXITING == ")
+        exit()
+
+    if len(args.files) > 0:
+        emapfiles = args.files
+    else:
+        emapfiles = sorted(os.path.join(args.inputdir, emapfile) for emapfile in os.listdir(args.inputdir) if emapfile.endswith('.annotations'))
+
+    for emapfile in emapfiles:
+        if args.force is False and has_columnar(emapfile):
+            print(emapfile, 'has an up-to-date Parquet file, skipping')
+            continue
+        now = datetime.datetime.now().strftime("[%Y-%m-%d %H:%M:%S]")
+        rows = write_columnar(emapfile)
+        print(now, ' converted', rows, 'rows of', emapfile, 'to', columnar_name(emapfile))
+
+    # bye bye
+    print('\nAll done - bye bye!')
+
+if __name__ == "__main__": main(sys.argv[1:])
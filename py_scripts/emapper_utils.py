@@ -0,0 +1,329 @@
+#!/usr/bin/python3
+
+# shared helpers for the scripts working on emapper annotations
+
+import os
+import re
+import hashlib
+import struct
+from collections import Counter
+
+import numpy as np
+import pandas as pd
+
+# first bytes of the per-sample count cache files (.ecache)
+ECACHE_MAGIC = b'ECACHE1\n'
+
+# flat list of all entries of a multi-valued column, in row order
+# split is the separator of the entries ('' splits after every letter, e.g. COG categories)
+def split_entries(values, split=','):
+    values = pd.Series(values, dtype=object).astype(str).tolist()
+    if split == '':
+        return list(''.join(values))
+    if len(values) == 0:
+        return []
+    return split.join(values).split(split)
+
+# number of entries in every row of a multi-valued column
+def entries_per_row(values, split=','):
+    values = pd.Series(values, dtype=object).astype(str)
+    if split == '':
+        return values.str.len().to_numpy()
+    return values.str.count(re.escape(split)).to_numpy() + 1
+
+# one row per entry of a multi-valued column, paired with the id of the row it came from
+# (same rows as concatenating one pd.Series(id, entries) per row)
+def explode_entries(ids, values, split=','):
+    return pd.DataFrame({'entry': split_entries(values, split),
+        'id': np.repeat(np.asarray(ids), entries_per_row(values, split))})
+
+# counts of every entry of a multi-valued column, most frequent first
+def count_entries(values, split=','):
+    counter = EntryCounter(split)
+    counter.update(values)
+    return counter.result()
+
+# running counts of the entries of a multi-valued column, updated chunk by chunk
+# (memory only grows with the number of distinct entries)
+class EntryCounter(object):
+    def __init__(self, split=','):
+        self.split = split
+        self.counts = Counter()
+    def update(self, values):
+        self.counts.update(split_entries(values, self.split))
+    # counts of every entry, most frequent first and ties in order of first occurrence
+    def result(self):
+        counts = pd.Series(list(self.counts.values()), index=pd.Index(list(self.counts.keys()), dtype=object), dtype='int64')
+        return counts.sort_values(ascending=False, kind='stable')
+
+# multi-valued columns of the emapper annotations (emapper 2.0 and 2.1 names) and the separator
+# of their entries, stored as list columns in the columnar files ('' splits after every letter)
+MULTI_VALUED = {'GOs': ',', 'EC': ',', 'KEGG_ko': ',', 'KEGG_Pathway': ',', 'KEGG_Module': ',',
+    'KEGG_Reaction': ',', 'KEGG_rclass': ',', 'BRITE': ',', 'KEGG_TC': ',', 'CAZy': ',',
+    'BiGG_Reaction': ',', 'PFAMs': ',', 'eggNOG OGs': ',', 'eggNOG_OGs': ',',
+    'COG Functional cat.': '', 'COG_category': ''}
+
+# numeric columns of the emapper annotations, stored as float64 in the columnar files
+NUMERIC = ['seed_ortholog_evalue', 'seed_ortholog_score', 'evalue', 'score']
+
+# name of the columnar (Parquet) file of an annotation file, written next to it by emapper_to_parquet.py
+def columnar_name(filename):
+    return filename + '.parquet'
+
+# True if the annotation file has a columnar file that is not older than the annotation file
+# (and pyarrow is installed to read it)
+def has_columnar(filename):
+    parquet = columnar_name(filename)
+    if not os.path.exists(parquet) or os.path.getmtime(parquet) < os.path.getmtime(filename):
+        return False
+    try:
+        import pyarrow.parquet
+    except ImportError:
+        return False
+    return True
+
+# convert an emapper annotation table into a typed columnar file (see columnar_name)
+# multi-valued columns become list columns, numeric columns float64, all others strings
+# returns the number of rows
+def write_columnar(filename):
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.parquet as pq
+    table = pd.read_csv(filename, sep='\t', skiprows=3, dtype=str)
+    # drop the trailing ## lines
+    table = table[~table[table.columns[0]].str.startswith('##', na=False)].reset_index(drop=True)
+    arrays = []
+    for column in table.columns:
+        if column in NUMERIC:
+            arrays.append(pa.array(pd.to_numeric(table[column]), type=pa.float64(), from_pandas=True))
+        elif column in MULTI_VALUED and MULTI_VALUED[column] == '':
+            arrays.append(pa.array([None if pd.isna(value) else list(value) for value in table[column]],
+                type=pa.list_(pa.string())))
+        elif column in MULTI_VALUED:
+            strings = pa.array(table[column], type=pa.string(), from_pandas=True)
+            arrays.append(pc.split_pattern(strings, MULTI_VALUED[column]))
+        else:
+            arrays.append(pa.array(table[column], type=pa.string(), from_pandas=True))
+    parquet = columnar_name(filename)
+    tmpname = '%s.%i.tmp' % (parquet, os.getpid())
+    pq.write_table(pa.Table.from_arrays(arrays, names=list(table.columns)), tmpname)
+    os.replace(tmpname, parquet)
+    return len(table)
+
+# column names of an annotation table (from the columnar file if there is one)
+def annotation_columns(filename):
+    if has_columnar(filename):
+        import pyarrow.parquet as pq
+        return pq.read_schema(columnar_name(filename)).names
+    return pd.read_csv(filename, sep='\t', skiprows=3, nrows=0).columns.tolist()
+
+# read the given columns of a columnar file, list columns are joined back with their separator
+# so that the tables are the same as read from the annotation file
+def read_columnar(parquet, usecols, chunksize=None):
+    import pyarrow.compute as pc
+    import pyarrow.parquet as pq
+    def to_frame(batch):
+        columns = []
+        for column in batch.schema.names:
+            values = batch.column(column)
+            if column in MULTI_VALUED:
+                values = pc.binary_join(values, MULTI_VALUED[column])
+            columns.append(values.to_pandas())
+        return pd.DataFrame(dict(zip(batch.schema.names, columns)))
+    if chunksize is not None:
+        return (to_frame(batch) for batch in pq.ParquetFile(parquet).iter_batches(batch_size=chunksize, columns=usecols))
+    return to_frame(pq.read_table(parquet, columns=usecols))
+
+# read an emapper annotation table with only the given columns (skip first 3 rows)
+# if there is an up-to-date columnar file only its given columns are read
+# with chunksize an iterator over tables of at most chunksize rows is returned
+def read_annotations(filename, usecols, chunksize=None):
+    if has_columnar(filename):
+        return read_columnar(columnar_name(filename), usecols, chunksize)
+    return pd.read_csv(filename, sep='\t', skiprows=3, usecols=usecols, chunksize=chunksize)
+
+# read the columns at the given positions (0-based) of an annotation table, the columns
+# of the tables are the positions (header line and ## lines are skipped)
+# dtype maps positions to the type of their column (the columnar files hold strings already)
+def read_annotation_positions(filename, positions, chunksize=None, dtype=None):
+    if has_columnar(filename):
+        names = annotation_columns(filename)
+        rename = dict((names[position], position) for position in positions)
+        tables = read_columnar(columnar_name(filename), [names[position] for position in sorted(positions)], chunksize)
+        if chunksize is not None:
+            return (table.rename(columns=rename) for table in tables)
+        return tables.rename(columns=rename)
+    return pd.read_csv(filename, sep='\t', usecols=sorted(positions), index_col=False, header=None,
+        comment='#', chunksize=chunksize, dtype=dtype)
+
+# sparse feature x sample count matrix of a cohort, built in one step from the per-sample counts
+#   features: sorted names of all features (global feature index, one row each), can be given
+#     to keep rows without counts
+#   indptr, indices, data: CSR layout, indices are the sample columns of every row
+#   (int64 counts, float64 if any of the per-sample counts are floats, e.g. split rollup weights)
+class CountMatrix(object):
+    def __init__(self, sample_names, sample_counts, features=None):
+        self.sample_names = list(sample_names)
+        # COO triplets: feature names, sample column and count of every non-zero entry
+        names = [np.asarray(counts.index, dtype=object) for counts in sample_counts]
+        values = [np.asarray(counts) for counts in sample_counts]
+        dtype = np.float64 if any(v.dtype.kind == 'f' for v in values) else np.int64
+        names = np.concatenate(names) if names else np.empty(0, dtype=object)
+        cols = np.repeat(np.arange(len(values), dtype=np.int64), [len(v) for v in values])
+        values = np.concatenate(values).astype(dtype) if values else np.empty(0, dtype=dtype)
+        # global feature index, rows are the position of every name in it
+        if features is None:
+            self.features, rows = np.unique(names, return_inverse=True)
+        else:
+            self.features = np.asarray(features, dtype=object)
+            rows = pd.Index(self.features).get_indexer(names)
+        rows = rows.reshape(-1)
+        # COO -> CSR, the stable sort keeps the sample order within every row
+        order = np.argsort(rows, kind='stable')
+        self.indices = cols[order]
+        self.data = values[order]
+        self.indptr = np.zeros(len(self.features) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(rows, minlength=len(self.features)), out=self.indptr[1:])
+
+    # dense table with one column per sample, first column name holds the features
+    # with as_merged the samples without some of the features get float64 columns, as written
+    # before by the outer pd.merge per sample and fillna(0) (e.g. 0.0 and 12.0)
+    def to_frame(self, name='#NAME', as_merged=True):
+        dense = np.zeros((len(self.features), len(self.sample_names)), dtype=self.data.dtype)
+        rows = np.repeat(np.arange(len(self.features)), np.diff(self.indptr))
+        dense[rows, self.indices] = self.data
+        table = pd.DataFrame(dense, columns=self.sample_names)
+        if as_merged is True:
+            entries = np.bincount(self.indices, minlength=len(self.sample_names))
+            for sample, num_entries in zip(self.sample_names, entries.tolist()):
+                if num_entries < len(self.features):
+                    table[sample] = table[sample].astype(np.float64)
+        table.insert(0, name, self.features)
+        return table
+
+    # save the matrix as scipy-compatible CSR .npz or as Matrix Market .mtx
+    # (.mtx gets the feature and sample names in .rows.tsv and .samples.tsv next to it)
+    def save(self, filename):
+        if filename.endswith('.npz'):
+            # file object, numpy would add .npz to other names
+            out = open(filename, 'wb')
+            np.savez_compressed(out, data=self.data, indices=self.indices, indptr=self.indptr,
+                shape=np.array([len(self.features), len(self.sample_names)]), format=np.array('csr'),
+                features=np.array(self.features, dtype=str), samples=np.array(self.sample_names, dtype=str))
+            out.close()
+            return
+        rows = np.repeat(np.arange(1, len(self.features) + 1), np.diff(self.indptr))
+        out = open(filename, 'w')
+        if self.data.dtype.kind == 'f':
+            field, entry_format = 'real', '%i %i %r\n'
+        else:
+            field, entry_format = 'integer', '%i %i %i\n'
+        out.write('%%%%MatrixMarket matrix coordinate %s general\n' % field)
+        out.write('%i %i %i\n' % (len(self.features), len(self.sample_names), len(self.data)))
+        out.writelines(entry_format % entry for entry in zip(rows.tolist(), (self.indices + 1).tolist(), self.data.tolist()))
+        out.close()
+        with open(filename + '.rows.tsv', 'w') as out:
+            out.writelines('%s\n' % feature for feature in self.features)
+        with open(filename + '.samples.tsv', 'w') as out:
+            out.writelines('%s\n' % sample for sample in self.sample_names)
+
+# name of the cache file holding the counts of one category of an annotation file
+# the key combines path, modification time and size of the file with a tag describing the category
+def cache_name(cache_dir, filename, tag):
+    stat = os.stat(filename)
+    key = '%s\t%i\t%i\t%s' % (os.path.abspath(filename), stat.st_mtime_ns, stat.st_size, tag)
+    return os.path.join(cache_dir, hashlib.sha1(key.encode()).hexdigest() + '.ecache')
+
+# SHA-1 digest of the file content, stored in the cache files so that a file
+# rewritten with the same size and time is not taken from the cache
+def file_digest(filename):
+    digest = hashlib.sha1()
+    with open(filename, 'rb') as infile:
+        for chunk in iter(lambda: infile.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.digest()
+
+# load cached counts (layout: magic, content digest, number of entries n, n int64 counts, entry names)
+# returns None if there is no valid cache file for this content
+def load_cached_counts(filename, digest):
+    try:
+        with open(filename, 'rb') as infile:
+            data = infile.read()
+    except OSError:
+        return None
+    pos = len(ECACHE_MAGIC)
+    if data[:pos] != ECACHE_MAGIC or data[pos:pos+len(digest)] != digest:
+        return None
+    pos += len(digest)
+    num_entries = struct.unpack_from('<q', data, pos)[0]
+    pos += 8
+    counts = np.frombuffer(data, dtype='<i8', count=num_entries, offset=pos).astype(np.int64)
+    names = data[pos + 8 * num_entries:].decode().split('\n') if num_entries > 0 else []
+    # mark the file as recently used
+    os.utime(filename)
+    return pd.Series(counts, index=pd.Index(names, dtype=object), dtype='int64')
+
+# save counts into a cache file (see load_cached_counts)
+# the file is written under a temporary name and renamed when complete
+def save_cached_counts(filename, digest, counts):
+    tmpname = '%s.%i.tmp' % (filename, os.getpid())
+    with open(tmpname, 'wb') as outfile:
+        outfile.write(ECACHE_MAGIC)
+        outfile.write(digest)
+        outfile.write(struct.pack('<q', len(counts)))
+        outfile.write(np.asarray(counts, dtype='<i8').tobytes())
+        outfile.write('\n'.join(str(name) for name in counts.index).encode())
+    os.replace(tmpname, filename)
+
+# remove the least recently used cache files until the cache directory is not larger than max_size bytes
+def prune_cache(cache_dir, max_size):
+    entries = []
+    total_size = 0
+    for name in os.listdir(cache_dir):
+        if not name.endswith('.ecache'):
+            continue
+        stat = os.stat(os.path.join(cache_dir, name))
+        entries.append((stat.st_mtime, name, stat.st_size))
+        total_size += stat.st_size
+    entries.sort()
+    for mtime, name, size in entries:
+        if total_size <= max_size:
+            break
+        os.remove(os.path.join(cache_dir, name))
+        total_size -= size
+
+# read a KO -> pathway/module mapping file: tab-separated KO and target, one pair per line
+# (e.g. KEGG link/pathway/ko or link/module/ko output), prefixes like ko:, path: and md: are removed
+# KEGG lists every pathway both as mapXXXXX and koXXXXX, the map entries are dropped (as ',map.*' in the emapper tables)
+def read_mapping(filename):
+    mapping = pd.read_csv(filename, sep='\t', header=None, usecols=[0,1], names=['feature','target'],
+        comment='#', dtype=str).dropna()
+    mapping = mapping.replace(to_replace='^[a-z]+:', value='', regex=True)
+    ko_pathways = set(mapping['target'][mapping['target'].str.startswith('ko')].str[2:])
+    duplicate = mapping['target'].str.startswith('map') & mapping['target'].str[3:].isin(ko_pathways)
+    return mapping[~duplicate].drop_duplicates()
+
+# roll a feature x sample table up into the targets of a mapping with one sparse matrix product
+#   features: names of the rows of matrix (feature x sample, dense or scipy sparse)
+#   split: the weight of a feature is divided evenly among its targets, otherwise it is added to each
+# returns the sorted targets with at least one feature in the table and the target x sample matrix
+def rollup(features, matrix, mapping, split=False):
+    try:
+        from scipy import sparse
+    except ImportError:
+        print("the rollup of KOs into pathways and modules requires scipy to be installed")
+        print(" == EXITING == ")
+        exit()
+    features = pd.Index(features).astype(str)
+    feature_codes = features.get_indexer(mapping['feature'])
+    found = feature_codes >= 0
+    feature_codes = feature_codes[found]
+    target_codes, targets = pd.factorize(mapping['target'][found], sort=True)
+    weights = np.ones(len(feature_codes), dtype=np.float64)
+    if split is True:
+        weights /= np.bincount(feature_codes, minlength=len(features))[feature_codes]
+    rollup_matrix = sparse.csr_matrix((weights, (target_codes, feature_codes)), shape=(len(targets), len(features)))
+    result = rollup_matrix @ matrix
+    if sparse.issparse(result):
+        result = result.toarray()
+    return targets, np.asarray(result)